@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+# Copyright (c) 2021 David Steele <dsteele@gmail.com>
+#
+# SPDX-License-Identifier: GPL-2.0-or-later
+# License-Filename: LICENSE
+
+"""Measure the rate of state transitions through the --ndjson event stream.
+
+Ping results alternate for a set of hosts, so every message is a change.
+The events are written to /dev/null.
+
+    $ python3 bench/event_stream.py [count]
+"""
+
+import asyncio
+import logging
+import sys
+import time
+
+from comitup_watch import comitup_mon
+from comitup_watch.messages import (
+    AvahiAction,
+    AvahiMessage,
+    PingAction,
+    PingMessage,
+)
+from comitup_watch.ndjson import NdjsonWriter
+
+HOSTS = 1000
+
+
+async def bench(count):
+    mon = comitup_mon.ComitupMon(render=False)
+    mon.log.disabled = True
+
+    for index in range(HOSTS):
+        name = "host{}".format(index)
+        mon.q.put_nowait(
+            AvahiMessage(
+                AvahiAction.ADDED,
+                name + "._comitup._tcp.local.",
+                name + ".local",
+                "10.0.{}.{}".format(index >> 8, index & 255),
+                None,
+            )
+        )
+    while not mon.q.empty():
+        await mon.run_batch()
+
+    with open("/dev/null", "w") as out:
+        writer = NdjsonWriter(out)
+        mon.add_sink(writer)
+
+        actions = [PingAction.ADDED, PingAction.REMOVED]
+        start = time.perf_counter()
+
+        for index in range(count):
+            action = actions[(index // HOSTS) % 2]
+            mon.q.put_nowait(
+                PingMessage(action, "host{}".format(index % HOSTS))
+            )
+            if mon.q.qsize() >= mon.batch_limit:
+                while not mon.q.empty():
+                    await mon.run_batch()
+
+        while not mon.q.empty():
+            await mon.run_batch()
+        writer.close()
+
+        elapsed = time.perf_counter() - start
+
+    print(
+        "{} transitions in {:.2f}s: {:.0f}/s, {} writes".format(
+            writer.lines, elapsed, writer.lines / elapsed, writer.writes
+        )
+    )
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+
+    logging.getLogger("comitup-watch").disabled = True
+    asyncio.run(bench(count))
+
+
+if __name__ == "__main__":
+    main()
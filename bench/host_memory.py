@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+# Copyright (c) 2021 David Steele <dsteele@gmail.com>
+#
+# SPDX-License-Identifier: GPL-2.0-or-later
+# License-Filename: LICENSE
+
+"""Measure the memory used per ComitupHost record.
+
+The messages are built before measuring, so that only the host records,
+and not the strings they refer to, are counted.
+
+    $ python3 bench/host_memory.py [count]
+"""
+
+import gc
+import logging
+import sys
+import tracemalloc
+
+from comitup_watch.comitup_mon import ComitupHost
+from comitup_watch.messages import (
+    AvahiAction,
+    AvahiMessage,
+    DeviceMonAction,
+    DeviceMonMsg,
+    PingAction,
+    PingMessage,
+)
+
+
+def build_messages(count):
+    return [
+        (
+            "host{}".format(x),
+            AvahiMessage(
+                AvahiAction.ADDED,
+                "host{}._comitup._tcp.local.".format(x),
+                "host{}.local".format(x),
+                "10.{}.{}.{}".format(x >> 16, (x >> 8) & 255, x & 255),
+                "fe80::{:x}".format(x),
+            ),
+            DeviceMonMsg(DeviceMonAction.ADDED, "comitup-{}".format(x)),
+            PingMessage(PingAction.ADDED, "host{}".format(x)),
+        )
+        for x in range(count)
+    ]
+
+
+def build_hosts(messages, log):
+    hosts = []
+    for hostname, avahi, nm, ping in messages:
+        host = ComitupHost(hostname, None, log)
+        host.add_avahi(avahi)
+        host.add_nm(nm)
+        host.add_ping(ping)
+        hosts.append(host)
+
+    return hosts
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+
+    log = logging.getLogger("comitup-watch-bench")
+    log.disabled = True
+
+    messages = build_messages(count)
+    gc.collect()
+
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    hosts = build_hosts(messages, log)
+    gc.collect()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    print(
+        "{} hosts: {:.1f} MiB, {:.0f} bytes per host".format(
+            len(hosts), (after - before) / 2**20, (after - before) / count
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -5,35 +5,114 @@
 
 
 import asyncio
+import logging
 import re
-from enum import Enum
-from typing import List, NamedTuple, Optional
+from typing import Dict, List, Optional, Set, Union
 
-import zeroconf
-from zeroconf import ServiceBrowser, Zeroconf
+import ifaddr
+from zeroconf import (
+    DNSOutgoing,
+    DNSQuestion,
+    InterfaceChoice,
+    IPVersion,
+    ServiceStateChange,
+    const,
+    current_time_millis,
+)
+from zeroconf.asyncio import (
+    AsyncServiceBrowser,
+    AsyncServiceInfo,
+    AsyncZeroconf,
+)
 
+from .messages import AvahiAction, AvahiMessage
 
-class AvahiAction(Enum):
-    ADDED = "ADDED"
-    REMOVED = "REMOVED"
+SERVICE_TYPE = "_comitup._tcp.local."
 
+DEFAULT_LIMIT = 32
 
-class AvahiMessage(NamedTuple):
-    action: AvahiAction
-    key: str
-    # name: str
-    host: str
-    ipv4: str
-    ipv6: str
+RESOLVE_TIMEOUT = 3000
+
+# startup PTR query times, and the wait for answers after the last one
+BURST_DELAYS = [0.0, 0.1, 0.3, 0.7, 1.5]
+BURST_SETTLE = 0.5
+
+# seconds between confirmations of the services still in the cache
+REFRESH_PERIOD = 300.0
+
+log = logging.getLogger("comitup-watch")
+
+IP_VERSIONS = {
+    "4": IPVersion.V4Only,
+    "6": IPVersion.V6Only,
+    "all": IPVersion.All,
+}
+
+
+def interface_addrs(
+    names: List[str], ip_version: Optional[str] = None
+) -> List[Union[str, int]]:
+    """Map interface names to the Zeroconf 'interfaces' list.
+
+    IPv4 interfaces are given by address, and IPv6 interfaces by index.
+    """
+    adapters = {x.nice_name: x for x in ifaddr.get_adapters()}
+    use_v4 = ip_version in [None, "4", "all"]
+    use_v6 = ip_version in ["6", "all"]
+
+    result: List[Union[str, int]] = []
+    for name in names:
+        if name not in adapters:
+            raise ValueError("Unknown interface '{}'".format(name))
+
+        adapter = adapters[name]
+        if use_v4:
+            result += [x.ip for x in adapter.ips if x.is_IPv4]
+        if use_v6 and any(x.is_IPv6 for x in adapter.ips):
+            result.append(adapter.index)
+
+    if not result:
+        raise ValueError(
+            "No usable addresses on interface(s) {}".format(", ".join(names))
+        )
+
+    return result
 
 
 class MyListener:
-    def __init__(self, zc, loop, q):
+    """Translate Comitup service browser events to AvahiMessages.
+
+    Services are resolved concurrently on the event loop, at most 'limit'
+    at a time, from the zeroconf record cache where possible. The last
+    message sent for each service is kept, so that re-announcements and
+    updates only produce a message if the host or an address changed.
+    """
+
+    def __init__(self, zc, q, limit: int = DEFAULT_LIMIT):
         self.zc = zc
-        self.loop = loop
         self.q = q
+        self.slots = asyncio.Semaphore(limit)
+        self.resolving: Dict[str, asyncio.Task] = {}
+        self.known: Dict[str, AvahiMessage] = {}
+        self.suppressed = 0
+        self.first_complete: Optional[float] = None
+        self.last_added: Optional[float] = None
+
+    def on_state_change(self, zeroconf, service_type, name, state_change):
+        if state_change is ServiceStateChange.Added:
+            self.add_service(zeroconf, service_type, name)
+        elif state_change is ServiceStateChange.Removed:
+            self.remove_service(zeroconf, service_type, name)
+        elif state_change is ServiceStateChange.Updated:
+            self.update_service(zeroconf, service_type, name)
 
     def remove_service(self, zeroconf, tipe, name):
+        task = self.resolving.pop(name, None)
+        if task is not None:
+            task.cancel()
+
+        self.known.pop(name, None)
+
         msg = AvahiMessage(
             AvahiAction.REMOVED,
             name,
@@ -42,7 +121,7 @@ class MyListener:
             None,
             None,
         )
-        asyncio.run_coroutine_threadsafe(self.q.put(msg), self.loop)
+        self.q.put_nowait(msg)
 
     def get_ipv4(self, addrlist: List[str], si) -> Optional[str]:
         for candidate in addrlist:
@@ -70,8 +149,24 @@ class MyListener:
 
         return None
 
-    def add_service(self, zeroconf, tipe, name):
-        si = self.zc.get_service_info("_comitup._tcp.local.", name)
+    async def get_service_info(self, name) -> Optional[AsyncServiceInfo]:
+        si = AsyncServiceInfo(SERVICE_TYPE, name)
+
+        if si.load_from_cache(self.zc):
+            return si
+
+        async with self.slots:
+            if await si.async_request(self.zc, RESOLVE_TIMEOUT):
+                return si
+
+        return None
+
+    async def resolve(self, name):
+        try:
+            si = await self.get_service_info(name)
+        finally:
+            if self.resolving.get(name) is asyncio.current_task():
+                del self.resolving[name]
 
         if si and b"hostname" in si.properties:
             msg = AvahiMessage(
@@ -82,27 +177,142 @@ class MyListener:
                 self.get_ipv4(si.parsed_addresses(), si),
                 self.get_ipv6(si.parsed_addresses(), si),
             )
-            asyncio.run_coroutine_threadsafe(self.q.put(msg), self.loop)
 
-    def update_service(self, *args, **kwargs):
-        pass
+            if self.known.get(name) == msg:
+                self.suppressed += 1
+                return
+
+            self.known[name] = msg
+            self.last_added = asyncio.get_event_loop().time()
+            await self.q.put(msg)
+
+    def add_service(self, zeroconf, tipe, name):
+        if name in self.resolving:
+            return
+
+        self.resolving[name] = asyncio.create_task(self.resolve(name))
 
+    async def settled(self) -> None:
+        """Wait until no services are being resolved."""
+        while self.resolving:
+            await asyncio.sleep(0.05)
 
-async def amain(event_queue):
+    def announced(self) -> Set[str]:
+        """Return the services with unexpired PTR records in the cache."""
+        now = current_time_millis()
+        records = self.zc.cache.async_all_by_details(
+            SERVICE_TYPE, const._TYPE_PTR, const._CLASS_IN
+        )
+
+        return {x.alias for x in records if not x.is_expired(now)}
+
+    def refresh(self) -> int:
+        """Confirm the services that are still announced, returning a count.
+
+        The browser reports a service as removed when its records expire,
+        but this lets the monitor evict anything it failed to hear about.
+        """
+        names = self.announced() & self.known.keys()
+        for name in names:
+            self.q.put_nowait(
+                self.known[name]._replace(action=AvahiAction.REFRESHED)
+            )
+
+        return len(names)
+
+    def update_service(self, zeroconf, tipe, name):
+        # resolve again, in case the update arrived mid-resolve
+        task = self.resolving.pop(name, None)
+        if task is not None:
+            task.cancel()
+
+        self.add_service(zeroconf, tipe, name)
+
+
+def ptr_query() -> DNSOutgoing:
+    out = DNSOutgoing(const._FLAGS_QR_QUERY, multicast=True)
+    out.add_question(
+        DNSQuestion(SERVICE_TYPE, const._TYPE_PTR, const._CLASS_IN)
+    )
+
+    return out
+
+
+async def startup_burst(zc, listener, delays=BURST_DELAYS) -> float:
+    """Query rapidly for Comitup services, and wait for them to resolve.
+
+    This fills the table without waiting on the browser's query backoff, or
+    for devices to re-announce. Returns the seconds taken until the table
+    was complete, that is, until the last service found in the burst was
+    added.
+    """
     loop = asyncio.get_event_loop()
+    start = loop.time()
+
+    await zc.async_wait_for_start()
+
+    for delay in delays:
+        await asyncio.sleep(max(0, start + delay - loop.time()))
+        zc.async_send(ptr_query())
+
+    await asyncio.sleep(BURST_SETTLE)
+    await listener.settled()
+
+    burst = loop.time() - start
+    complete = 0.0
+    if listener.last_added is not None:
+        complete = max(0.0, listener.last_added - start)
+
+    log.info(
+        "Startup discovery - {} services in {:.2f}s, burst {:.2f}s".format(
+            len(listener.known), complete, burst
+        )
+    )
 
-    avahi_q = asyncio.Queue()
+    return complete
 
-    zc = Zeroconf()
-    listener = MyListener(zc, loop, avahi_q)
-    ServiceBrowser(zc, "_comitup._tcp.local.", listener)
+
+async def amain(
+    event_queue,
+    limit: int = DEFAULT_LIMIT,
+    interfaces: Optional[List[str]] = None,
+    ip_version: Optional[str] = None,
+    burst: bool = True,
+    ready: Optional[asyncio.Event] = None,
+):
+    """Browse for Comitup services, optionally on just some interfaces.
+
+    'ready' is set once the startup discovery is complete.
+    """
+    if interfaces:
+        zc_interfaces = interface_addrs(interfaces, ip_version)
+    else:
+        zc_interfaces = InterfaceChoice.All
+
+    aiozc = AsyncZeroconf(
+        interfaces=zc_interfaces,
+        ip_version=IP_VERSIONS.get(ip_version),
+    )
+    listener = MyListener(aiozc.zeroconf, event_queue, limit)
+    browser = AsyncServiceBrowser(
+        aiozc.zeroconf, SERVICE_TYPE, handlers=[listener.on_state_change]
+    )
 
     try:
+        if burst:
+            listener.first_complete = await startup_burst(
+                aiozc.zeroconf, listener
+            )
+
+        if ready is not None:
+            ready.set()
+
         while True:
-            msg = await avahi_q.get()
-            await event_queue.put(msg)
+            await asyncio.sleep(REFRESH_PERIOD)
+            listener.refresh()
     finally:
-        zeroconf.close()
+        await browser.async_cancel()
+        await aiozc.async_close()
 
 
 def main():
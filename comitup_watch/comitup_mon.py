@@ -1,25 +1,52 @@
 import asyncio
+import heapq
 import logging
-import os
+import math
 import re
-from bisect import bisect_left
-from datetime import datetime, timedelta
+import signal
+import time
+from collections import Counter
 from functools import total_ordering, wraps
 from logging.handlers import TimedRotatingFileHandler
 from pathlib import Path
-from typing import NamedTuple
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    NamedTuple,
+    Optional,
+    Set,
+    Tuple,
+)
 
-import tabulate
 from colorama import Fore, Back, Style
 
-from .avahi_watch import AvahiMessage
-from .devicemon import DeviceMonMsg
-from .pingmon import PingMessage
+from .messages import (
+    AvahiAction,
+    AvahiMessage,
+    DeviceMonAction,
+    DeviceMonMsg,
+    PingMessage,
+)
+from .render import Table, TermRenderer
 
 
-new_delta = timedelta(seconds=30)
+# seconds that new information is highlighted
+new_delta = 30.0
 
-start_time = datetime.now()
+# seconds from startup to the first frame showing a device
+FIRST_FRAME_BUDGET = 1.0
+
+# seconds that each kind of data is kept without confirmation - see the
+# REFRESHED messages, and the 'ping' rule in ComitupHost.stale_kinds()
+EVICT_TTLS = {"nm": 900.0, "avahi": 900.0, "ping": 3600.0}
+
+SWEEP_PERIOD = 60.0
+
+start_time = time.monotonic()
 
 
 def deflog(verbose: bool = False) -> logging.Logger:
@@ -60,8 +87,93 @@ def Update(kind):
     return decorator
 
 
+class ExpiryMessage(NamedTuple):
+    tick: float
+
+
+class SweepMessage(NamedTuple):
+    tick: float
+
+
+class ExpiryTimer:
+    """Deliver an ExpiryMessage to a queue when highlight deadlines pass.
+
+    Deadlines are rounded up to 'resolution' seconds, and collapsed, so that
+    there is one pending timer, and one message per expiry tick, no matter
+    how many hosts were updated. The keys expiring in a tick are passed to
+    'callback', if set.
+    """
+
+    def __init__(
+        self,
+        q,
+        resolution: float = 1.0,
+        callback: Optional[Callable[[Set[str]], None]] = None,
+    ) -> None:
+        self.q = q
+        self.resolution = resolution
+        self.callback = callback
+        self.ticks: List[float] = []
+        self.tick_keys: Dict[float, Set[str]] = {}
+        self.handle: Optional[asyncio.TimerHandle] = None
+
+    def __len__(self) -> int:
+        return len(self.ticks)
+
+    def schedule(self, delay: float, key: Optional[str] = None) -> None:
+        loop = asyncio.get_event_loop()
+        tick = math.ceil((loop.time() + delay) / self.resolution)
+        tick *= self.resolution
+
+        if tick in self.tick_keys:
+            if key is not None:
+                self.tick_keys[tick].add(key)
+            return
+
+        self.tick_keys[tick] = set() if key is None else {key}
+        heapq.heappush(self.ticks, tick)
+
+        if self.ticks[0] == tick:
+            self._arm(loop)
+
+    def _arm(self, loop) -> None:
+        if self.handle is not None:
+            self.handle.cancel()
+
+        self.handle = loop.call_at(self.ticks[0], self._expire)
+
+    def _expire(self) -> None:
+        loop = asyncio.get_event_loop()
+        self.handle = None
+
+        tick = None
+        keys: Set[str] = set()
+        while self.ticks and self.ticks[0] <= loop.time():
+            tick = heapq.heappop(self.ticks)
+            keys |= self.tick_keys.pop(tick)
+
+        if tick is not None:
+            if self.callback is not None:
+                self.callback(keys)
+            self.q.put_nowait(ExpiryMessage(tick))
+
+        if self.ticks:
+            self._arm(loop)
+
+
 @total_ordering
 class ComitupHost:
+    """The data known for one device, from all of the sources.
+
+    Hosts are kept in 'slots', with a class-level schema mapping each data
+    attribute to the message field it is taken from. Update times are
+    monotonic, so the highlighting isn't upset by clock changes.
+
+    Update times record when each kind of data last changed, for
+    highlighting. Seen times record when it was last confirmed by its
+    source, for eviction.
+    """
+
     avahi_attrs = {
         "avahi_key": "key",
         "domain": "host",
@@ -75,101 +187,167 @@ class ComitupHost:
 
     ping_attrs = {"ping_status": "name"}
 
-    def __init__(self, hostname, event_q, log) -> None:
-        self.host: str = hostname
+    all_attrs = {**avahi_attrs, **nm_attrs, **ping_attrs}
 
-        init_time = datetime.now() - 2 * new_delta
-        self.update_time = {
-            "ping": init_time,
-            "nm": init_time,
-            "avahi": init_time,
-        }
+    # the attributes reported in change events, and their event names
+    event_fields = {
+        "ssid": "ssid",
+        "domain": "domain",
+        "ipv4": "ipv4",
+        "ipv6": "ipv6",
+        "ping_status": "ping",
+    }
 
-        self.update_flag = True
+    time_attrs = {
+        "avahi": "avahi_time",
+        "nm": "nm_time",
+        "ping": "ping_time",
+    }
 
-        self.last_check = datetime.now()
+    seen_attrs = {
+        "avahi": "avahi_seen",
+        "nm": "nm_seen",
+        "ping": "ping_seen",
+    }
+
+    __slots__ = (
+        "host",
+        *all_attrs,
+        *time_attrs.values(),
+        *seen_attrs.values(),
+        "ping_evicted",
+        "registry",
+        "row",
+        "q",
+        "log",
+    )
 
-        self.all_attrs = self.avahi_attrs.copy()
-        self.all_attrs.update(self.nm_attrs)
-        self.all_attrs.update(self.ping_attrs)
+    def __init__(self, hostname, event_q, log) -> None:
+        self.host: str = hostname
 
         for key in self.all_attrs:
             setattr(self, key, None)
 
+        # never highlighted, or seen, until updated
+        for key in [*self.time_attrs.values(), *self.seen_attrs.values()]:
+            setattr(self, key, -math.inf)
+
+        # no longer pinged, after going unanswered for the ping TTL
+        self.ping_evicted = False
+
+        self.registry = None
+        self.row: Optional[List[str]] = None
+
         self.q = event_q
 
         self.log = log
 
-    def update(self, kind):
-        self.update_time[kind] = datetime.now()
-        self.update_flag = True
-
-        class UpdateMessage(NamedTuple):
-            host: str
+    def update_time(self, kind) -> float:
+        return getattr(self, self.time_attrs[kind])
 
-        async def display_ping(q):
-            await asyncio.sleep(new_delta.seconds + 0.1)
-            await q.put(UpdateMessage(self.host))
+    def update(self, kind):
+        setattr(self, self.time_attrs[kind], time.monotonic())
+        self.changed()
 
-        asyncio.create_task(display_ping(self.q))
+        if self.registry is not None:
+            self.registry.timer.schedule(new_delta + 0.1, self.host)
 
     def is_new(self, kind):
-        if self.update_time[kind] - start_time > timedelta(seconds=5):
-            if datetime.now() - self.update_time[kind] < new_delta:
+        updated = self.update_time(kind)
+
+        # skip the initial discovery burst
+        if updated - start_time > 5:
+            if time.monotonic() - updated < new_delta:
                 return True
 
         return False
 
-    def needs_update(self):
+    def changed(self) -> None:
+        """Drop the cached display row, and flag the host for redisplay."""
+        self.row = None
 
-        now = datetime.now()
+        if self.registry is not None:
+            self.registry.dirty.add(self.host)
 
-        for kind in ["ping", "nm", "avahi"]:
-            if self.last_check < self.update_time[kind] + new_delta < now:
-                self.update_flag = True
+    def set_attr(self, key, val) -> bool:
+        """Set a data attribute, keeping the registry indexes in sync.
 
-        self.last_check = now
+        Returns True if the value changed.
+        """
+        old = getattr(self, key)
+        setattr(self, key, val)
 
-        if self.update_flag:
-            self.update_flag = False
-            return True
-        else:
+        if old == val:
             return False
 
-    @Update("avahi")
-    def add_avahi(self, msg: AvahiMessage) -> None:
-        for key in self.avahi_attrs:
-            setattr(self, key, getattr(msg, self.avahi_attrs[key]))
+        self.changed()
+
+        if self.registry is not None:
+            self.registry.reindex(self, key, old, val)
+            self.registry.note_change(self, key, val)
+
+        return True
+
+    def refresh(self, kind) -> None:
+        """Note that the source has confirmed this kind of data."""
+        setattr(self, self.seen_attrs[kind], time.monotonic())
+
+    def add_avahi(self, msg: AvahiMessage) -> bool:
+        """Apply avahi data, returning True if anything changed."""
+        self.refresh("avahi")
+
+        changes = [
+            self.set_attr(key, getattr(msg, field))
+            for key, field in self.avahi_attrs.items()
+        ]
+        if not any(changes):
+            return False
 
+        self.ping_evicted = False
+        self.update("avahi")
         self.log.info(
             "Connection info - {}: {} - {}".format(
                 self.domain, self.ipv4, self.ipv6
             )
         )
 
+        return True
+
     @Update("avahi")
     def rm_avahi(self) -> None:
         for key in self.avahi_attrs:
-            setattr(self, key, None)
+            self.set_attr(key, None)
 
         self.update("avahi")
 
-    @Update("nm")
-    def add_nm(self, msg: DeviceMonMsg) -> None:
-        for key in self.nm_attrs:
-            setattr(self, key, getattr(msg, self.nm_attrs[key]))
+    def add_nm(self, msg: DeviceMonMsg) -> bool:
+        """Apply NetworkManager data, returning True if anything changed."""
+        self.refresh("nm")
+
+        changes = [
+            self.set_attr(key, getattr(msg, field))
+            for key, field in self.nm_attrs.items()
+        ]
+        if not any(changes):
+            return False
+
+        self.update("nm")
+
+        return True
 
     @Update("nm")
     def rm_nm(self) -> None:
         for key in self.nm_attrs:
-            setattr(self, key, None)
+            self.set_attr(key, None)
 
     def add_ping(self, msg: PingMessage):
+        self.refresh("ping")
+
         if not self.ping_status:
             self.log.info("Ping success - {}".format(self.host))
             self.update("ping")
 
-        self.ping_status = True
+        self.set_attr("ping_status", True)
 
     def rm_ping(self):
         if self.ping_status:
@@ -177,11 +355,52 @@ class ComitupHost:
             self.update("ping")
 
         if self.ping_status is not None:
-            self.ping_status = False
+            self.set_attr("ping_status", False)
 
     def has_data(self) -> bool:
         return any([getattr(self, x) for x in self.all_attrs])
 
+    def stale_kinds(self, now: float, ttls: Dict[str, float]) -> List[str]:
+        """Return the kinds of data not confirmed within their TTLs.
+
+        'ping' is stale when a host has an address, but hasn't answered a
+        ping since it was announced, or since its last successful ping.
+        """
+        kinds = []
+
+        if self.ssid is not None and now - self.nm_seen > ttls["nm"]:
+            kinds.append("nm")
+
+        if self.avahi_key is not None:
+            if now - self.avahi_seen > ttls["avahi"]:
+                kinds.append("avahi")
+
+            alive = max(self.ping_seen, self.avahi_time)
+            if (
+                self.ipv4
+                and not self.ping_evicted
+                and now - alive > ttls["ping"]
+            ):
+                kinds.append("ping")
+
+        return kinds
+
+    def evict(self, kind) -> None:
+        """Drop a kind of data, as if its source had reported it removed.
+
+        An unresponsive host only loses its ping status, and is no longer
+        pinged until its addresses change. Its announced data is kept while
+        the avahi source confirms it.
+        """
+        if kind == "nm":
+            self.rm_nm()
+        elif kind == "avahi":
+            self.rm_avahi()
+            self.set_attr("ping_status", None)
+        else:
+            self.ping_evicted = True
+            self.set_attr("ping_status", None)
+
     def __eq__(self, other):
         return self.host == other.host
 
@@ -198,66 +417,261 @@ class ComitupHost:
 
         return output
 
-    def get_display_row(self):
+    def cells(self) -> List[Tuple[str, Optional[str]]]:
+        """Return the display columns, with the kind of data in each."""
         if self.ping_status is None:
             pstat = None
         else:
             pstat = "  \u2714" if self.ping_status else "  \u274C"
 
         return [
-            self.colorize("nm", self.ssid),
-            self.colorize("avahi", self.domain),
-            self.colorize("avahi", self.ipv4),
-            self.colorize("avahi", self.ipv6),
-            self.colorize("ping", pstat),
+            ("nm", self.ssid),
+            ("avahi", self.domain),
+            ("avahi", self.ipv4),
+            ("avahi", self.ipv6),
+            ("ping", pstat),
         ]
 
+    def get_display_row(self):
+        if self.row is not None:
+            return self.row
+
+        self.row = [self.colorize(kind, text) for kind, text in self.cells()]
+
+        return self.row
+
+    def get_plain_row(self) -> List[str]:
+        return [text or "" for _, text in self.cells()]
+
+    def as_dict(self) -> Dict[str, Any]:
+        result = {"host": self.host}
+        for attr, field in self.event_fields.items():
+            result[field] = getattr(self, attr)
+
+        return result
+
 
 class ComitupList:
+    """Registry of ComitupHosts, indexed by hostname and by key attributes.
+
+    Lookups by hostname, and by the attributes in 'indexed_attrs', are O(1).
+    The sorted display order is computed lazily, and only when the set of
+    hosts changes.
+
+    Hosts that have changed, or whose highlighting has expired, since the
+    last display are collected in 'dirty'.
+
+    Once 'track_changes()' is called, the changed event fields of each host
+    are also collected in 'changes', and removed hosts in 'removed', until
+    they are cleared by the consumer.
+    """
+
+    indexed_attrs = ["ipv4", "avahi_key", "ssid"]
+
     def __init__(self, event_q, log):
-        self.list = []
+        self.hosts: Dict[str, ComitupHost] = {}
+        self.attr_index: Dict[str, Dict[str, Dict[str, ComitupHost]]] = {
+            x: {} for x in self.indexed_attrs
+        }
+        self._ordered: Optional[List[ComitupHost]] = None
+        self._positions: Dict[str, int] = {}
+        self.dirty: Set[str] = set()
+
+        self.changes: Optional[Dict[str, Dict[str, Any]]] = None
+        self.removed: Set[str] = set()
+
         self.log = log
         self.q = event_q
 
-    def __len__(self) -> None:
-        return len(self.list)
+        self.timer = ExpiryTimer(event_q, callback=self.expire)
+
+    def expire(self, hostnames: Set[str]) -> None:
+        for hostname in hostnames:
+            host = self.hosts.get(hostname)
+            if host is not None:
+                host.changed()
+
+    def _order(self) -> List[ComitupHost]:
+        """Return the hosts in display order, sorting only if stale."""
+        if self._ordered is None:
+            self._ordered = sorted(self.hosts.values())
+            self._positions = {
+                host.host: index for index, host in enumerate(self._ordered)
+            }
+
+        return self._ordered
+
+    @property
+    def list(self) -> List[ComitupHost]:
+        return self._order()
+
+    @list.setter
+    def list(self, hosts: Iterable[ComitupHost]) -> None:
+        self.hosts = {}
+        for index in self.attr_index.values():
+            index.clear()
+        self._ordered = None
+
+        for host in hosts:
+            self.add_host(host)
+
+    def __len__(self) -> int:
+        return len(self.hosts)
+
+    def __iter__(self) -> Iterator[ComitupHost]:
+        return iter(self.list)
+
+    def reindex(self, host: ComitupHost, attr: str, old, new) -> None:
+        """Move a host between secondary index entries on attribute change."""
+        if attr not in self.attr_index or old == new:
+            return
+
+        index = self.attr_index[attr]
+
+        if old is not None and old in index:
+            index[old].pop(host.host, None)
+            if not index[old]:
+                del index[old]
+
+        if new is not None:
+            index.setdefault(new, {})[host.host] = host
+
+    def track_changes(self) -> None:
+        if self.changes is None:
+            self.changes = {}
+
+    def note_change(self, host: ComitupHost, attr: str, val) -> None:
+        if self.changes is None or attr not in host.event_fields:
+            return
+
+        fields = self.changes.setdefault(host.host, {})
+        fields[host.event_fields[attr]] = val
 
     def get_host_by_attr(self, attr: str, val: str) -> ComitupHost:
+        if attr == "host":
+            return self.hosts.get(val)
+
+        if attr in self.attr_index:
+            matches = self.attr_index[attr].get(val)
+            if matches:
+                return min(matches.values())
+            return None
+
         try:
             return [x for x in self.list if getattr(x, attr) == val][0]
         except IndexError:
             return None
 
     def get_host(self, hostname: str) -> ComitupHost:
-        return self.get_host_by_attr("host", hostname)
+        return self.hosts.get(hostname)
 
-    def add_host(self, host: ComitupHost) -> int:
-        if self.get_host(host.host):
+    def add_host(self, host: ComitupHost) -> None:
+        if host.host in self.hosts:
             raise Exception("Attempted to add duplicate host")
 
-        index: int = bisect_left(self.list, host)
-        self.list.insert(index, host)
+        self.hosts[host.host] = host
+        host.registry = self
+        for attr in self.attr_index:
+            self.reindex(host, attr, None, getattr(host, attr))
 
-        return index
+        # the display position is found lazily, with _index()
+        self._ordered = None
+        self.dirty.add(host.host)
 
     def _index(self, hostname: str) -> int:
-        index = [
-            index
-            for index, host in enumerate(self.list)
-            if host.host == hostname
-        ][0]
-        return index
+        self._order()
+        return self._positions[hostname]
 
     def rm_host(self, hostname: str) -> None:
-        index = self._index(hostname)
-        del self.list[index]
+        host = self.hosts.pop(hostname)
+        host.registry = None
+        for attr in self.attr_index:
+            self.reindex(host, attr, getattr(host, attr), None)
+
+        self._ordered = None
+        self.dirty.add(hostname)
+
+        if self.changes is not None:
+            self.changes.setdefault(hostname, {})
+            self.removed.add(hostname)
 
     def __getitem__(self, index):
         return self.list.__getitem__(index)
 
+    def snapshot(self) -> List[Dict[str, Any]]:
+        """Return the hosts, in display order, as plain dicts."""
+        return [x.as_dict() for x in self]
+
+
+class BatchStats:
+    """Event batch sizes and processing latencies, for ComitupMon.run."""
+
+    def __init__(self) -> None:
+        self.batches = 0
+        self.events = 0
+        self.last_size = 0
+        self.max_size = 0
+        self.last_latency = 0.0
+        self.max_latency = 0.0
+        self.total_latency = 0.0
+
+    def record(self, size: int, latency: float) -> None:
+        self.batches += 1
+        self.events += size
+        self.last_size = size
+        self.max_size = max(self.max_size, size)
+        self.last_latency = latency
+        self.max_latency = max(self.max_latency, latency)
+        self.total_latency += latency
+
+    @property
+    def mean_size(self) -> float:
+        return self.events / self.batches if self.batches else 0.0
+
+    @property
+    def mean_latency(self) -> float:
+        return self.total_latency / self.batches if self.batches else 0.0
+
+    def __str__(self) -> str:
+        return (
+            "{} events in {} batches - size mean {:.1f} max {}, "
+            "latency mean {:.1f}ms max {:.1f}ms".format(
+                self.events,
+                self.batches,
+                self.mean_size,
+                self.max_size,
+                self.mean_latency * 1000,
+                self.max_latency * 1000,
+            )
+        )
+
 
 class ComitupMon:
-    def __init__(self):
+    """Apply source events to the host list, and show the result.
+
+    With 'render' False, the terminal display is skipped. Functions added
+    with 'add_sink()' are called with an event dict for each host changed
+    by a source message.
+    """
+
+    msg_sources = {
+        DeviceMonMsg: "nm",
+        AvahiMessage: "avahi",
+        PingMessage: "ping",
+        SweepMessage: "sweep",
+    }
+
+    def __init__(
+        self,
+        max_fps: float = 10,
+        batch_limit: int = 1000,
+        batch_deadline: float = 0.05,
+        started: Optional[float] = None,
+        first_frame_budget: float = FIRST_FRAME_BUDGET,
+        ttls: Optional[Dict[str, float]] = None,
+        sweep_period: float = SWEEP_PERIOD,
+        render: bool = True,
+    ):
         self.q = asyncio.Queue()
         self.ping_q = asyncio.Queue()
 
@@ -265,6 +679,29 @@ class ComitupMon:
 
         self.clist = ComitupList(self.q, self.log)
 
+        self.renderer = TermRenderer(max_fps=max_fps)
+        self.table = Table(["SSID", "Domain Name", "IPv4", "IPv6", "Ping"])
+        self.frame_handle: Optional[asyncio.TimerHandle] = None
+
+        self.batch_limit = batch_limit
+        self.batch_deadline = batch_deadline
+        self.stats = BatchStats()
+        self.logged_batches = 0
+
+        self.started = started if started is not None else time.monotonic()
+        self.first_frame_budget = first_frame_budget
+        self.first_frame: Optional[float] = None
+
+        self.ttls = dict(EVICT_TTLS, **(ttls or {}))
+        self.sweep_period = sweep_period
+        self.sweep_handle: Optional[asyncio.TimerHandle] = None
+        self.evictions: Counter = Counter()
+
+        self.last_event = self.started
+
+        self.render = render
+        self.sinks: List[Callable[[Dict[str, Any]], None]] = []
+
         self.log.info("Starting comitup-watch")
 
     def event_queue(self):
@@ -283,11 +720,24 @@ class ComitupMon:
         return host
 
     def proc_dev_msg(self, msg):
-        host = self.get_host(msg.ssid)
+        if msg.action.name == "REFRESHED":
+            host = self.clist.get_host(msg.ssid)
+            if host is not None and host.ssid == msg.ssid:
+                host.refresh("nm")
+                return
+
+            # confirmed, but evicted or missed - apply it again
+            msg = msg._replace(action=DeviceMonAction.ADDED)
+
         if msg.action.name == "ADDED":
-            self.log.info("Added SSID = {}".format(host.host))
-            host.add_nm(msg)
+            host = self.get_host(msg.ssid)
+            if host.add_nm(msg):
+                self.log.info("Added SSID = {}".format(host.host))
         else:
+            host = self.clist.get_host(msg.ssid)
+            if host is None:
+                return
+
             self.log.info("Removed SSID = {}".format(host.host))
             host.rm_nm()
             if not host.has_data():
@@ -297,24 +747,43 @@ class ComitupMon:
         match = re.search(r"^([^\.]+)", msg.key)
         hostname = match.group(1)
 
-        host = self.get_host(hostname)
+        if msg.action.name == "REFRESHED":
+            host = self.clist.get_host(hostname)
+            if host is not None and host.avahi_key == msg.key:
+                host.refresh("avahi")
+                return
+
+            # confirmed, but evicted or missed - apply it again
+            msg = msg._replace(action=AvahiAction.ADDED)
+
         if msg.action.name == "ADDED":
+            host = self.get_host(hostname)
+            if not host.add_avahi(msg):
+                return
+
             self.log.info("Added Network Data = {}".format(hostname))
-            host.add_avahi(msg)
             try:
                 self.ping_q.put_nowait(hostname)
             except asyncio.QeueueFull:
                 pass
 
         else:
+            # e.g. a service that went away before it was resolved
+            host = self.clist.get_host(hostname)
+            if host is None:
+                return
+
             self.log.info("Removed Network Data = {}".format(hostname))
             host.rm_avahi()
-            host.ping_status = None
+            host.set_attr("ping_status", None)
             if not host.has_data():
                 self.clist.rm_host(hostname)
 
     def proc_ping_msg(self, msg):
-        host = self.get_host(msg.name)
+        # a result can arrive after its host was removed
+        host = self.clist.get_host(msg.name)
+        if host is None:
+            return
 
         if msg.action.name == "ADDED":
             host.add_ping(msg)
@@ -323,41 +792,246 @@ class ComitupMon:
             if not host.has_data():
                 self.clist.rm_host(msg.name)
 
+    def proc_msg(self, msg) -> None:
+        if type(msg) == DeviceMonMsg:
+            self.proc_dev_msg(msg)
+        elif type(msg) == AvahiMessage:
+            self.proc_avahi_msg(msg)
+        elif type(msg) == PingMessage:
+            self.proc_ping_msg(msg)
+        elif type(msg) == SweepMessage:
+            self.sweep(msg.tick)
+
+        if self.clist.changes:
+            self.emit_changes(self.msg_sources.get(type(msg)))
+
+    def add_sink(self, sink: Callable[[Dict[str, Any]], None]) -> None:
+        """Send an event to 'sink' for each host changed by a message."""
+        self.sinks.append(sink)
+        self.clist.track_changes()
+
+    def emit_changes(self, source: Optional[str]) -> None:
+        now = time.monotonic()
+
+        for hostname, fields in self.clist.changes.items():
+            event = {
+                "t": now,
+                "host": hostname,
+                "source": source,
+                "changes": fields,
+            }
+            if hostname in self.clist.removed:
+                event["removed"] = True
+
+            for sink in self.sinks:
+                sink(event)
+
+        self.clist.changes = {}
+        self.clist.removed.clear()
+
+    def sweep(self, now: float) -> None:
+        """Evict data that hasn't been confirmed within its TTL."""
+        evicted: Counter = Counter()
+
+        for host in list(self.clist.hosts.values()):
+            kinds = host.stale_kinds(now, self.ttls)
+            if not kinds:
+                continue
+
+            for kind in kinds:
+                host.evict(kind)
+                evicted[kind] += 1
+
+            if not host.has_data():
+                self.clist.rm_host(host.host)
+                evicted["hosts"] += 1
+
+        if evicted:
+            self.evictions.update(evicted)
+            self.log.info(
+                "Evicted stale data - {}".format(
+                    self.eviction_summary(evicted)
+                )
+            )
+
+    def eviction_summary(self, counts: Optional[Counter] = None) -> str:
+        counts = self.evictions if counts is None else counts
+        return ", ".join(
+            "{}: {}".format(x, counts[x])
+            for x in ["nm", "avahi", "ping", "hosts"]
+        )
+
+    def log_stats(self) -> None:
+        """Log the event batch statistics, if there are new batches."""
+        if self.stats.batches == self.logged_batches:
+            return
+
+        self.logged_batches = self.stats.batches
+        self.log.info("Event batches - {}".format(self.stats))
+
+    def _sweep_due(self) -> None:
+        self.log_stats()
+        self.q.put_nowait(SweepMessage(time.monotonic()))
+
+        loop = asyncio.get_event_loop()
+        self.sweep_handle = loop.call_later(self.sweep_period, self._sweep_due)
+
+    async def run_batch(self) -> int:
+        """Apply all queued events (within limits), then redraw at most once.
+
+        Returns the number of events processed.
+        """
+        msg = await self.q.get()
+        start = time.monotonic()
+        deadline = start + self.batch_deadline
+        self.last_event = start
+
+        self.proc_msg(msg)
+        count = 1
+
+        while count < self.batch_limit and time.monotonic() < deadline:
+            try:
+                msg = self.q.get_nowait()
+            except asyncio.QueueEmpty:
+                break
+
+            self.proc_msg(msg)
+            count += 1
+
+        if self.clist.dirty:
+            if self.render:
+                self.request_frame()
+            else:
+                self.clist.dirty.clear()
+
+        self.stats.record(count, time.monotonic() - start)
+
+        return count
+
+    async def wait_quiet(
+        self,
+        quiet: float,
+        deadline: float,
+        ready: Callable[[], bool] = lambda: True,
+    ) -> bool:
+        """Wait until 'ready()', and no events for 'quiet' seconds.
+
+        Gives up 'deadline' seconds after startup, returning False. The
+        events are processed by 'run()', which must be running.
+        """
+        end = self.started + deadline
+
+        while True:
+            now = time.monotonic()
+
+            if now - self.last_event >= quiet and self.q.empty() and ready():
+                return True
+
+            if now >= end:
+                return False
+
+            await asyncio.sleep(min(0.05, quiet, end - now))
+
+    def snapshot_lines(self) -> List[str]:
+        """Return the host table, without highlighting."""
+        table = Table(self.table.header)
+        for host in self.clist:
+            table.set_row(host.host, host.get_plain_row())
+
+        return table.lines(x.host for x in self.clist)
+
     def test_table(self):
         table = [x.get_display_row() for x in self.clist]
         return table
 
+    def get_frame(self) -> List[str]:
+        for hostname in self.clist.dirty:
+            host = self.clist.get_host(hostname)
+            if host is None:
+                self.table.remove_row(hostname)
+            else:
+                self.table.set_row(hostname, host.get_display_row())
+
+        table_lines = self.table.lines(x.host for x in self.clist)
+
+        # the second line is the uncolored header rule
+        width = len(table_lines[1])
+
+        header = ["-" * width, "COMITUP-WATCH".center(width)]
+        if self.evictions:
+            header.append(
+                "Evicted - {}".format(self.eviction_summary()).center(width)
+            )
+
+        return header + ["-" * width] + table_lines
+
     def print_list(self):
-        os.system("clear")
+        self.renderer.render(self.get_frame())
+        self.clist.dirty.clear()
+
+        if self.first_frame is None and len(self.clist):
+            self.record_first_frame()
 
-        header = ["SSID", "Domain Name", "IPv4", "IPv6", "Ping"]
+    def record_first_frame(self) -> None:
+        """Log the time taken to show the first device, against the budget."""
+        self.first_frame = time.monotonic() - self.started
 
-        tabulate.PRESERVE_WHITESPACE = True
-        table_text = tabulate.tabulate(self.test_table(), header)
-        width = max(len(x) for x in table_text.split("\n") if "--" in x)
+        msg = "First device shown after {:.0f}ms".format(
+            self.first_frame * 1000
+        )
+        if self.first_frame > self.first_frame_budget:
+            self.log.warning(
+                "{}, over the {:.0f}ms budget".format(
+                    msg, self.first_frame_budget * 1000
+                )
+            )
+        else:
+            self.log.info(msg)
 
-        print("-" * width)
-        print("COMITUP-WATCH".center(width))
-        print("-" * width)
+    def _deferred_frame(self) -> None:
+        self.frame_handle = None
+        self.print_list()
 
-        print(table_text)
+    def request_frame(self) -> None:
+        """Draw a frame now, or as soon as the frame rate cap allows."""
+        delay = self.renderer.delay()
+
+        if not delay:
+            if self.frame_handle is not None:
+                self.frame_handle.cancel()
+                self.frame_handle = None
+            self.print_list()
+        elif self.frame_handle is None:
+            loop = asyncio.get_event_loop()
+            self.frame_handle = loop.call_later(delay, self._deferred_frame)
+
+    def on_resize(self) -> None:
+        self.renderer.invalidate()
+        self.request_frame()
 
     async def run(self):
+        loop = asyncio.get_event_loop()
 
-        print("\x1b[?25l")
+        if self.render:
+            print("\x1b[?25l")
 
-        try:
-            while True:
-                msg = await self.q.get()
+            try:
+                loop.add_signal_handler(signal.SIGWINCH, self.on_resize)
+            except (NotImplementedError, RuntimeError):
+                pass
+
+            # draw the empty table while the sources start
+            self.request_frame()
 
-                if type(msg) == DeviceMonMsg:
-                    self.proc_dev_msg(msg)
-                elif type(msg) == AvahiMessage:
-                    self.proc_avahi_msg(msg)
-                elif type(msg) == PingMessage:
-                    self.proc_ping_msg(msg)
+        self.sweep_handle = loop.call_later(self.sweep_period, self._sweep_due)
 
-                if any([x.needs_update() for x in self.clist]):
-                    self.print_list()
+        try:
+            while True:
+                await self.run_batch()
         finally:
-            print("\x1b[?25h")
+            self.sweep_handle.cancel()
+            self.log_stats()
+            self.log.info("Evictions - {}".format(self.eviction_summary()))
+
+            if self.render:
+                print("\x1b[?25h")
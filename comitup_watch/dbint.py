@@ -4,8 +4,32 @@
 # License-Filename: LICENSE
 
 
+import time
+from collections import OrderedDict
+from typing import NamedTuple
+
+
+class CacheStats(NamedTuple):
+    size: int
+    hits: int
+    misses: int
+    evictions: int
+
+
 class DBInt:
-    _cache = {}
+    """Shared D-Bus access, with an LRU cache of interface proxies.
+
+    Proxies are dropped when the cache exceeds 'cache_size' entries, when
+    they are older than 'cache_ttl' seconds, or when their object path is
+    invalidated (e.g. when NM removes the AccessPoint or Device).
+    """
+
+    _cache = OrderedDict()
+    cache_size = 256
+    cache_ttl = 3600.0
+    hits = 0
+    misses = 0
+    evictions = 0
     bus = None
 
     def __init__(self, bus):
@@ -13,13 +37,39 @@ class DBInt:
 
     @staticmethod
     async def get_interface(busname, path, interface):
-        if (busname, path, interface) not in DBInt._cache:
-            intfc = await DBInt.bus[busname][path].get_async_interface(
-                interface
-            )
-            DBInt._cache[(busname, path, interface)] = intfc
+        key = (busname, str(path), interface)
+        now = time.monotonic()
+
+        entry = DBInt._cache.get(key)
+        if entry is not None and now - entry[1] < DBInt.cache_ttl:
+            DBInt._cache.move_to_end(key)
+            DBInt.hits += 1
+            return entry[0]
+
+        DBInt.misses += 1
 
-        return DBInt._cache[(busname, path, interface)]
+        intfc = await DBInt.bus[busname][path].get_async_interface(interface)
+        DBInt._cache[key] = (intfc, now)
+        DBInt._cache.move_to_end(key)
+
+        while len(DBInt._cache) > DBInt.cache_size:
+            DBInt._cache.popitem(last=False)
+            DBInt.evictions += 1
+
+        return intfc
+
+    @staticmethod
+    def invalidate(path) -> None:
+        """Drop any cached proxies for an object path."""
+        path = str(path)
+        for key in [x for x in DBInt._cache if x[1] == path]:
+            del DBInt._cache[key]
+
+    @staticmethod
+    def cache_stats() -> CacheStats:
+        return CacheStats(
+            len(DBInt._cache), DBInt.hits, DBInt.misses, DBInt.evictions
+        )
 
     @staticmethod
     async def GetAllDevices():
@@ -5,29 +5,327 @@
 
 
 import asyncio
+import logging
 import re
-from enum import Enum
-from typing import List, NamedTuple, Set
+import time
+from typing import (
+    Awaitable,
+    Callable,
+    Dict,
+    List,
+    NamedTuple,
+    Optional,
+    Set,
+)
 
 import dbussy
 import ravel
 
 from .dbint import DBInt
+from .messages import DeviceMonAction, DeviceMonMsg
 
+log = logging.getLogger("comitup-watch")
 
-class DeviceMonAction(Enum):
-    ADDED = "ADDED"
-    REMOVED = "REMOVED"
 
-
-class DeviceMonMsg(NamedTuple):
-    action: DeviceMonAction
+class AccessPoint(NamedTuple):
     ssid: str
+    strength: Optional[int]
+    frequency: Optional[int]
+    hwaddress: Optional[str]
+
+
+def ap_from_props(props) -> Optional[AccessPoint]:
+    """Build an AccessPoint from a GetAll property dict, if it has an SSID."""
+
+    def value(name):
+        variant = props.get(name)
+        return variant[1] if variant is not None else None
+
+    ssid = bytearray(value("Ssid") or b"").decode(errors="replace")
+    if not ssid:
+        return None
+
+    return AccessPoint(
+        ssid,
+        value("Strength"),
+        value("Frequency"),
+        value("HwAddress"),
+    )
+
+
+NM_DEVICE_TYPE_WIFI = 2
+NM_DEVICE_STATE_DISCONNECTED = 30
+NM_DEVICE_STATE_ACTIVATED = 100
+
+
+class Coalescer:
+    """Run an async job on request, merging bursts of requests into one run.
+
+    The job runs once requests have been quiet for 'window' seconds, but no
+    later than 'max_delay' seconds after the first pending request. Requests
+    made while the job is running cause one trailing run. The window
+    doubles, up to 'max_window', when requests keep arriving during it, and
+    halves, down to 'min_window', when it passes quietly.
+    """
+
+    def __init__(
+        self,
+        job: Callable[[], Awaitable[None]],
+        min_window: float = 0.1,
+        max_window: float = 2.0,
+        max_delay: float = 5.0,
+    ) -> None:
+        self.job = job
+        self.min_window = min_window
+        self.max_window = max_window
+        self.max_delay = max_delay
+        self.window = min_window
+
+        self.first_request: Optional[float] = None
+        self.last_request = 0.0
+        self.requests = 0
+        self.waiters: List[asyncio.Future] = []
+        self.task: Optional[asyncio.Task] = None
+
+        self.runs = 0
+        self.merged = 0
+
+    def request(self) -> asyncio.Future:
+        """Request a run, returning a future completed when it finishes."""
+        loop = asyncio.get_event_loop()
+        now = loop.time()
+
+        if self.first_request is None:
+            self.first_request = now
+        self.last_request = now
+        self.requests += 1
+
+        waiter = loop.create_future()
+        self.waiters.append(waiter)
+
+        if self.task is None:
+            self.task = asyncio.create_task(self._runner())
+
+        return waiter
+
+    async def run(self) -> None:
+        await asyncio.shield(self.request())
+
+    async def _debounce(self) -> None:
+        loop = asyncio.get_event_loop()
+
+        while True:
+            wake = min(
+                self.last_request + self.window,
+                self.first_request + self.max_delay,
+            )
+            if loop.time() >= wake:
+                return
+
+            await asyncio.sleep(wake - loop.time())
+
+    async def _runner(self) -> None:
+        try:
+            while self.first_request is not None:
+                await self._debounce()
+
+                if self.requests > 1:
+                    self.window = min(2 * self.window, self.max_window)
+                else:
+                    self.window = max(self.window / 2, self.min_window)
+
+                self.merged += self.requests - 1
+                self.runs += 1
+
+                waiters = self.waiters
+                self.waiters = []
+                self.first_request = None
+                self.requests = 0
+
+                try:
+                    await self.job()
+                except Exception as e:
+                    log.error("Coalesced job failed - {}".format(e))
+
+                for waiter in waiters:
+                    if not waiter.done():
+                        waiter.set_result(None)
+        finally:
+            self.task = None
+
+
+class WirelessDevice:
+    """A NM wireless device, owning its AccessPoint signal subscriptions."""
+
+    interface = "org.freedesktop.NetworkManager.Device.Wireless"
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.counts = {"AccessPointAdded": 0, "AccessPointRemoved": 0}
+        self.handlers = {
+            "AccessPointAdded": self.ap_added_signal,
+            "AccessPointRemoved": self.ap_removed_signal,
+        }
+        self.subscribed = False
+
+    def subscribe(self) -> None:
+        if self.subscribed:
+            return
+
+        for name, func in self.handlers.items():
+            DBInt.bus.listen_signal(
+                path=self.path,
+                fallback=False,
+                interface=self.interface,
+                name=name,
+                func=func,
+            )
+
+        self.subscribed = True
+
+    def unsubscribe(self) -> None:
+        if not self.subscribed:
+            return
+
+        for name, func in self.handlers.items():
+            DBInt.bus.unlisten_signal(
+                path=self.path,
+                fallback=False,
+                interface=self.interface,
+                name=name,
+                func=func,
+            )
+
+        self.subscribed = False
+
+    @ravel.signal(name="AccessPointAdded", in_signature="o")
+    async def ap_added_signal(self, path):
+        self.counts["AccessPointAdded"] += 1
+        await APManager.ap_added(str(path))
+
+    @ravel.signal(name="AccessPointRemoved", in_signature="o")
+    async def ap_removed_signal(self, path):
+        self.counts["AccessPointRemoved"] += 1
+        await APManager.ap_removed(str(path))
+
+
+class ScanScheduler:
+    """Periodically ask NM to scan for APs, via RequestScan.
+
+    Unconnected wireless devices are preferred - connected devices are only
+    used if there are no others. Scans are at least 'min_interval' seconds
+    apart. The interval doubles, up to 'max_interval', while scans find no
+    new SSIDs, or NM refuses the request, and resets when one is found.
+    'latency' is the time from a scan request to the first new SSID seen.
+    """
+
+    def __init__(
+        self,
+        monitor: "DeviceMonitor",
+        min_interval: float = 10,
+        max_interval: float = 120,
+        settle: float = 5,
+    ) -> None:
+        self.monitor = monitor
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.settle = settle
+        self.interval = min_interval
+
+        self.scans = 0
+        self.refused = 0
+        self.latency: Optional[float] = None
+
+    async def get_state(self, path: str) -> Optional[int]:
+        intfc = await DBInt.get_interface(
+            "org.freedesktop.NetworkManager",
+            path,
+            "org.freedesktop.DBus.Properties",
+        )
+
+        try:
+            return (
+                await intfc.Get(
+                    "org.freedesktop.NetworkManager.Device", "State"
+                )
+            )[0][1]
+        except dbussy.DBusError:
+            return None
+
+    async def targets(self) -> List[str]:
+        """Pick the devices to scan - unconnected ones if there are any."""
+        paths = list(self.monitor.devices)
+        states = await asyncio.gather(*[self.get_state(x) for x in paths])
+
+        idle = [
+            path
+            for path, state in zip(paths, states)
+            if state == NM_DEVICE_STATE_DISCONNECTED
+        ]
+        if idle:
+            return idle
+
+        return [
+            path
+            for path, state in zip(paths, states)
+            if state == NM_DEVICE_STATE_ACTIVATED
+        ]
+
+    async def request_scan(self, path: str) -> bool:
+        intfc = await DBInt.get_interface(
+            "org.freedesktop.NetworkManager",
+            path,
+            "org.freedesktop.NetworkManager.Device.Wireless",
+        )
+
+        try:
+            await intfc.RequestScan({})
+        except dbussy.DBusError as e:
+            # NM rate limits scans, and refuses them while busy
+            log.debug("Scan request refused for {} - {}".format(path, e))
+            self.refused += 1
+            return False
+
+        self.scans += 1
+        return True
+
+    async def scan(self) -> None:
+        """Scan once, and adjust the interval per the result."""
+        started = time.monotonic()
+        found = APManager.new_ssid_count
+
+        for path in await self.targets():
+            await self.request_scan(path)
+
+        await asyncio.sleep(self.settle)
+
+        if APManager.new_ssid_count > found:
+            self.latency = APManager.last_new_ssid - started
+            self.interval = self.min_interval
+        else:
+            self.interval = min(2 * self.interval, self.max_interval)
+
+        log.debug(
+            "Scan interval {}s, SSID discovery latency {}".format(
+                self.interval, self.latency
+            )
+        )
+
+    async def run(self) -> None:
+        while True:
+            started = time.monotonic()
+            await self.scan()
+            await asyncio.sleep(
+                max(0, started + self.interval - time.monotonic())
+            )
 
 
 class DeviceMonitor(DBInt):
-    def __init__(self, bus, event_queue):
-        self.dev_paths = set()
+    def __init__(self, bus, event_queue, scan_interval: float = 10):
+        self.devices: Dict[str, WirelessDevice] = {}
+        self.scanner: Optional[ScanScheduler] = None
+        if scan_interval:
+            self.scanner = ScanScheduler(self, min_interval=scan_interval)
 
         self.event_queue = event_queue
         APManager.event_queue = event_queue
@@ -35,13 +333,12 @@ class DeviceMonitor(DBInt):
         super().__init__(bus)
 
     async def startup(self) -> None:
+        """Register the wireless devices, and report the initial SSIDs.
 
-        await asyncio.sleep(0.1)
-
-        for devpath in await self.GetAllDevices():
-            # print(devpath)
-            await self.add_dev_path(devpath)
-
+        The device signals are subscribed first, so that nothing is missed
+        while the devices are checked, concurrently. The first SSID list is
+        fetched directly, rather than waiting out the rescan debounce.
+        """
         DBInt.bus.listen_signal(
             path="/org/freedesktop/NetworkManager",
             fallback=False,
@@ -58,64 +355,99 @@ class DeviceMonitor(DBInt):
             func=self.device_removed_signal,
         )
 
-        await APManager.update_ssid_list()
+        await asyncio.gather(
+            *[self.add_dev_path(x) for x in await self.GetAllDevices()]
+        )
 
-    async def add_dev_path(self, path):
+        await APManager._locked_update_ssid_list()
 
-        if str(path) not in self.dev_paths:
-            self.dev_paths |= set(str(path))
+        self.reconcile_task = asyncio.create_task(APManager.reconcile())
 
-            DBInt.bus.listen_signal(
-                path=path,
-                fallback=False,
-                interface="org.freedesktop.NetworkManager.Device.Wireless",
-                name="AccessPointAdded",
-                func=self.ap_added_signal,
-            )
+        if self.scanner is not None:
+            self.scan_task = asyncio.create_task(self.scanner.run())
 
-            DBInt.bus.listen_signal(
-                path=path,
-                fallback=False,
-                interface="org.freedesktop.NetworkManager.Device.Wireless",
-                name="AccessPointRemoved",
-                func=self.ap_removed_signal,
-            )
+    async def is_wireless(self, path) -> bool:
+        intfc = await self.get_interface(
+            "org.freedesktop.NetworkManager",
+            path,
+            "org.freedesktop.DBus.Properties",
+        )
+
+        try:
+            devtype = (
+                await intfc.Get(
+                    "org.freedesktop.NetworkManager.Device", "DeviceType"
+                )
+            )[0][1]
+        except dbussy.DBusError:
+            return False
+
+        return devtype == NM_DEVICE_TYPE_WIFI
+
+    async def add_dev_path(self, path) -> bool:
+        """Register a wireless device, returning True if it is new."""
+        path = str(path)
+
+        if path in self.devices or not await self.is_wireless(path):
+            return False
+
+        # the device may have been added while checking the type
+        if path in self.devices:
+            return False
+
+        device = WirelessDevice(path)
+        self.devices[path] = device
+        device.subscribe()
+
+        return True
+
+    def rm_dev_path(self, path) -> bool:
+        device = self.devices.pop(str(path), None)
+
+        if device is None:
+            return False
+
+        device.unsubscribe()
+
+        return True
+
+    def signal_counts(self) -> Dict[str, Dict[str, int]]:
+        """Return the AccessPoint signal counts per wireless device."""
+        return {path: dict(x.counts) for path, x in self.devices.items()}
 
     @ravel.signal(name="DeviceAdded", in_signature="o")
     async def device_added_signal(self, path):
         # print("strpath", path)
-        await self.add_dev_path(path)
+        if await self.add_dev_path(path):
+            APManager.request_rescan()
 
     @ravel.signal(name="DeviceRemoved", in_signature="o")
     async def device_removed_signal(self, path):
 
         # print("Removing device path", path)
 
-        if str(path) in self.dev_paths:
+        DBInt.invalidate(path)
+        if self.rm_dev_path(path):
+            APManager.request_rescan()
 
-            self.dev_paths -= set(path)
-
-            DBInt.bus().unlisten_signal(
-                path=path,
-                fallback=False,
-                interface="org.freedesktop.NetworkManager.Device.Wireless",
-                name="AccessPointAdded",
-                func=self.ap_added_signal,
-            )
-
-    @ravel.signal(name="AccessPointAdded", in_signature="o")
-    async def ap_added_signal(self, path):
-        await APManager.update_ssid_list()
 
-    @ravel.signal(name="AccessPointRemoved", in_signature="o")
-    async def ap_removed_signal(self, path):
-        await APManager.update_ssid_list()
+class APManager(DBInt):
+    """Track the SSIDs visible to NetworkManager, per AccessPoint path.
 
+    AccessPoints are added and removed individually, as signalled, with a
+    reference count per SSID so that an SSID is only reported lost when the
+    last AP carrying it goes away. A full rescan reconciles the state every
+    'reconcile_period' seconds, in case a signal was missed.
+    """
 
-class APManager(DBInt):
-    _ssids: Set[str] = set()
+    _aps: Dict[str, AccessPoint] = {}
+    _ssid_refs: Dict[str, int] = {}
     _lock: asyncio.locks.Lock = asyncio.Lock()
-    _waiting: bool = False
+    _rescans: Optional["Coalescer"] = None
+    reconcile_period: float = 300
+    fetch_limit: int = 16
+    new_ssid_count: int = 0
+    last_new_ssid: float = 0.0
     event_queue = None
 
     @classmethod
@@ -144,68 +476,187 @@ class APManager(DBInt):
         return paths
 
     @classmethod
-    async def new_ssid_list(klass):
+    async def get_ap(klass, ap_path: str) -> Optional[AccessPoint]:
+        """Get the properties of one AccessPoint, in a single call."""
+        intfc = await klass.get_interface(
+            "org.freedesktop.NetworkManager",
+            ap_path,
+            "org.freedesktop.DBus.Properties",
+        )
+
+        try:
+            props = (
+                await intfc.GetAll(
+                    "org.freedesktop.NetworkManager.AccessPoint"
+                )
+            )[0]
+        except dbussy.DBusError:
+            return None
+
+        return ap_from_props(props)
+
+    @classmethod
+    async def get_managed_aps(klass) -> Optional[Dict[str, AccessPoint]]:
+        """Get all AccessPoints via the NM ObjectManager, if supported."""
+        intfc = await klass.get_interface(
+            "org.freedesktop.NetworkManager",
+            "/org/freedesktop",
+            "org.freedesktop.DBus.ObjectManager",
+        )
+
+        try:
+            objects = (await intfc.GetManagedObjects())[0]
+        except dbussy.DBusError:
+            return None
+
+        aps = {}
+        for path, intfcs in objects.items():
+            props = intfcs.get("org.freedesktop.NetworkManager.AccessPoint")
+            if props is not None:
+                ap = ap_from_props(props)
+                if ap is not None:
+                    aps[str(path)] = ap
+
+        return aps
+
+    @classmethod
+    async def new_aps(klass) -> Dict[str, AccessPoint]:
+        """Get all current AccessPoints, in as few round trips as possible.
+
+        This is a single GetManagedObjects call where NM supports it, or
+        else concurrent GetAll calls, at most 'fetch_limit' at a time.
+        """
+        aps = await klass.get_managed_aps()
+        if aps is not None:
+            return aps
+
+        slots = asyncio.Semaphore(klass.fetch_limit)
+
+        async def fetch(ap_path):
+            async with slots:
+                return ap_path, await klass.get_ap(ap_path)
+
+        results = await asyncio.gather(
+            *[fetch(x) for x in await klass.update_ap_paths()]
+        )
+
+        return {path: ap for path, ap in results if ap is not None}
+
+    @classmethod
+    async def new_ssid_list(klass) -> Set[str]:
         """Get a current list of SSIDs per the current NM AccessPoint's."""
+        return set(x.ssid for x in (await klass.new_aps()).values())
 
-        ssids = set()
-        for ap_path in await klass.update_ap_paths():
-            intfc = await klass.get_interface(
-                "org.freedesktop.NetworkManager",
-                ap_path,
-                "org.freedesktop.DBus.Properties",
-            )
+    @classmethod
+    def access_points(klass) -> Dict[str, AccessPoint]:
+        """Return the known AccessPoints carrying an SSID, by path."""
+        return dict(klass._aps)
+
+    @classmethod
+    async def _add_ap(klass, ap_path: str, ap: AccessPoint) -> None:
+        klass._aps[ap_path] = ap
+        klass._ssid_refs[ap.ssid] = klass._ssid_refs.get(ap.ssid, 0) + 1
+
+        if klass._ssid_refs[ap.ssid] == 1:
+            await klass.new_ssid(ap.ssid)
+
+    @classmethod
+    async def _rm_ap(klass, ap_path: str) -> None:
+        ap = klass._aps.pop(ap_path, None)
+        if ap is None:
+            return
+
+        klass._ssid_refs[ap.ssid] -= 1
+        if not klass._ssid_refs[ap.ssid]:
+            del klass._ssid_refs[ap.ssid]
+            await klass.lost_ssid(ap.ssid)
 
-            try:
-                ssid = (
-                    await intfc.Get(
-                        "org.freedesktop.NetworkManager.AccessPoint", "Ssid"
-                    )
-                )[0][1]
-                ssid = bytearray(ssid).decode()
+    @classmethod
+    async def ap_added(klass, ap_path: str) -> None:
+        """Add a single AccessPoint, fetching only its own properties."""
+        async with klass._lock:
+            if ap_path in klass._aps:
+                return
 
-                if ssid:
-                    ssids |= set([ssid])
-            except dbussy.DBusError:
-                pass
+            ap = await klass.get_ap(ap_path)
+            if ap is not None:
+                await klass._add_ap(ap_path, ap)
 
-        return ssids
+    @classmethod
+    async def ap_removed(klass, ap_path: str) -> None:
+        klass.invalidate(ap_path)
+
+        async with klass._lock:
+            await klass._rm_ap(ap_path)
 
     @classmethod
     async def _update_ssid_list(klass):
         """Find changes in the SSID space, w/ callbacks indicating changes."""
-        new_list = await klass.new_ssid_list()
+        new_aps = await klass.new_aps()
 
-        new_ssids = new_list - klass._ssids
-        for new_ssid in new_ssids:
-            await klass.new_ssid(new_ssid)
+        new_refs: Dict[str, int] = {}
+        for ap in new_aps.values():
+            new_refs[ap.ssid] = new_refs.get(ap.ssid, 0) + 1
 
-        klass._ssids |= new_ssids
+        for lost_path in klass._aps.keys() - new_aps.keys():
+            klass.invalidate(lost_path)
 
-        lost_ssids = klass._ssids - new_list
-        for lost_ssid in lost_ssids:
-            await klass.lost_ssid(lost_ssid)
+        old_refs = klass._ssid_refs
+        klass._aps = new_aps
+        klass._ssid_refs = new_refs
 
-        klass._ssids -= lost_ssids
+        for new_ssid in new_refs.keys() - old_refs.keys():
+            await klass.new_ssid(new_ssid)
+
+        for lost_ssid in old_refs.keys() - new_refs.keys():
+            await klass.lost_ssid(lost_ssid)
 
     @classmethod
-    async def update_ssid_list(klass):
+    async def _locked_update_ssid_list(klass):
         """Wrap the SSID update call with an asyncio Lock."""
+        async with klass._lock:
+            await klass._update_ssid_list()
 
-        if klass._waiting:
-            return
+    @classmethod
+    def rescans(klass) -> "Coalescer":
+        if klass._rescans is None:
+            klass._rescans = Coalescer(klass._locked_update_ssid_list)
 
-        # print("updating ssid_list")
+        return klass._rescans
 
-        klass._waiting = True
-        async with klass._lock:
-            await asyncio.sleep(0.5)
-            klass._waiting = False
+    @classmethod
+    def request_rescan(klass) -> None:
+        """Ask for a full rescan, coalesced with any other requests."""
+        klass.rescans().request()
 
-            await klass._update_ssid_list()
+    @classmethod
+    async def update_ssid_list(klass):
+        """Request a full rescan, and wait for it to complete."""
+        await klass.rescans().run()
+
+    @classmethod
+    async def refresh(klass) -> None:
+        """Confirm that the current SSIDs are still visible."""
+        for ssid in list(klass._ssid_refs):
+            msg = DeviceMonMsg(DeviceMonAction.REFRESHED, ssid)
+            await klass.event_queue.put(msg)
+
+    @classmethod
+    async def reconcile(klass):
+        """Periodically rescan all AccessPoints, as a safety net."""
+        while True:
+            await asyncio.sleep(klass.reconcile_period)
+            await klass.update_ssid_list()
+            await klass.refresh()
+
+            log.debug("D-Bus proxy cache - {}".format(klass.cache_stats()))
 
     @classmethod
     async def new_ssid(klass, ssid):
         # print("new ssid", ssid)
+        klass.new_ssid_count += 1
+        klass.last_new_ssid = time.monotonic()
+
         msg = DeviceMonMsg(DeviceMonAction.ADDED, ssid)
         await klass.event_queue.put(msg)
 
@@ -0,0 +1,296 @@
+# Copyright (c) 2021 David Steele <dsteele@gmail.com>
+#
+# SPDX-License-Identifier: GPL-2.0-or-later
+# License-Filename: LICENSE
+
+
+import asyncio
+import json
+import logging
+import os
+from typing import Any, Dict, Optional, Set, Tuple
+
+DEFAULT_HOST = "127.0.0.1"
+CLIENT_BUFFER = 256
+KEEPALIVE = 15.0
+IDLE_TIMEOUT = 60.0
+MAX_HEADER = 16 * 1024
+MAX_BODY = 64 * 1024
+
+log = logging.getLogger("comitup-watch")
+
+REASONS = {
+    200: "OK",
+    304: "Not Modified",
+    400: "Bad Request",
+    404: "Not Found",
+    405: "Method Not Allowed",
+}
+
+
+def parse_address(text: str) -> Tuple[str, int]:
+    """Parse '[HOST:]PORT', with IPv6 hosts in brackets."""
+    host, sep, port = text.rpartition(":")
+    if not sep:
+        host = DEFAULT_HOST
+
+    try:
+        port_num = int(port)
+    except ValueError:
+        raise ValueError("Invalid port '{}'".format(port))
+
+    return host.strip("[]") or DEFAULT_HOST, port_num
+
+
+class EventClient:
+    """A server-sent events connection, fed from a bounded buffer."""
+
+    def __init__(self, writer: asyncio.StreamWriter, size: int) -> None:
+        self.writer = writer
+        self.queue: asyncio.Queue = asyncio.Queue(size)
+        self.dropped = False
+
+    def send(self, data: bytes) -> bool:
+        """Queue an event, returning False if the client has fallen behind."""
+        try:
+            self.queue.put_nowait(data)
+        except asyncio.QueueFull:
+            return False
+
+        return True
+
+    def drop(self) -> None:
+        # wait_for() can swallow a cancel, so the flag is checked as well
+        self.dropped = True
+        self.writer.close()
+
+    async def run(self) -> None:
+        while True:
+            try:
+                data = await asyncio.wait_for(self.queue.get(), KEEPALIVE)
+            except asyncio.TimeoutError:
+                data = b": keepalive\n\n"
+
+            if self.dropped:
+                return
+
+            self.writer.write(data)
+            await self.writer.drain()
+
+
+class StatusServer:
+    """Serve the host list over HTTP, as a snapshot and as a change stream.
+
+    'GET /hosts' returns the ComitupList snapshot as JSON. It is serialized
+    at most once per change generation, and is tagged with the generation,
+    so that unchanged polls get a bodiless 304.
+
+    'GET /events' is a server-sent events stream of the per-host change
+    events. Each event is encoded once, and queued for every client in a
+    buffer of 'client_buffer' events. A client whose buffer fills is
+    dropped, so that the monitor is never held up by a slow reader.
+    """
+
+    def __init__(
+        self,
+        comitupmon,
+        host: str = DEFAULT_HOST,
+        port: int = 8080,
+        client_buffer: int = CLIENT_BUFFER,
+    ) -> None:
+        self.comitupmon = comitupmon
+        self.host = host
+        self.port = port
+        self.client_buffer = client_buffer
+
+        self.server: Optional[asyncio.AbstractServer] = None
+        self.clients: Dict[EventClient, asyncio.Task] = {}
+        self.connections: Set[asyncio.StreamWriter] = set()
+
+        # distinguishes the ETags of different runs
+        self.run_id = os.urandom(4).hex()
+        self.generation = 0
+        self.cached: Optional[Tuple[int, bytes]] = None
+
+        self.snapshots = 0
+        self.not_modified = 0
+        self.dropped = 0
+
+        comitupmon.add_sink(self.on_change)
+
+    async def start(self) -> None:
+        self.server = await asyncio.start_server(
+            self.handle, self.host, self.port, limit=MAX_HEADER
+        )
+        log.info("Serving status on {}:{}".format(self.host, self.port))
+
+    async def close(self) -> None:
+        for task in self.clients.values():
+            task.cancel()
+
+        if self.server is not None:
+            self.server.close()
+
+            # wait_closed() waits on open connections, kept alive or not
+            for writer in list(self.connections):
+                writer.close()
+            await self.server.wait_closed()
+
+        log.info(
+            "HTTP - {} snapshots, {} not modified, {} clients dropped".format(
+                self.snapshots, self.not_modified, self.dropped
+            )
+        )
+
+    def etag(self) -> str:
+        return '"{}-{}"'.format(self.run_id, self.generation)
+
+    def on_change(self, event: Dict[str, Any]) -> None:
+        self.generation += 1
+
+        if not self.clients:
+            return
+
+        data = "id: {}\ndata: {}\n\n".format(
+            self.generation, json.dumps(event, separators=(",", ":"))
+        ).encode()
+
+        for client in [x for x in self.clients if not x.send(data)]:
+            self.dropped += 1
+            log.warning("Dropping a slow event stream client")
+            client.drop()
+            self.clients.pop(client).cancel()
+
+    def snapshot(self) -> bytes:
+        if self.cached is None or self.cached[0] != self.generation:
+            body = json.dumps(self.comitupmon.clist.snapshot()).encode()
+            self.cached = (self.generation, body)
+            self.snapshots += 1
+
+        return self.cached[1]
+
+    def respond(
+        self,
+        writer: asyncio.StreamWriter,
+        status: int,
+        headers: Dict[str, str],
+        body: bytes = b"",
+    ) -> None:
+        lines = ["HTTP/1.1 {} {}".format(status, REASONS[status])]
+        lines += ["{}: {}".format(k, v) for k, v in headers.items()]
+        if status != 304:
+            lines.append("Content-Length: {}".format(len(body)))
+
+        writer.write("\r\n".join(lines).encode() + b"\r\n\r\n" + body)
+
+    async def handle(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        self.connections.add(writer)
+        try:
+            keep = True
+            while keep:
+                keep = await self.handle_request(reader, writer)
+                await writer.drain()
+        except (
+            asyncio.IncompleteReadError,
+            asyncio.LimitOverrunError,
+            asyncio.TimeoutError,
+            ConnectionError,
+        ):
+            pass
+        finally:
+            self.connections.discard(writer)
+            writer.close()
+
+    async def handle_request(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> bool:
+        """Answer one request, returning True to keep the connection open."""
+        head = await asyncio.wait_for(
+            reader.readuntil(b"\r\n\r\n"), IDLE_TIMEOUT
+        )
+        lines = head.decode("latin-1").split("\r\n")
+
+        try:
+            method, target, version = lines[0].split(" ")
+        except ValueError:
+            self.respond(writer, 400, {"Connection": "close"})
+            return False
+
+        headers = {}
+        for line in lines[1:]:
+            name, _, value = line.partition(":")
+            headers[name.strip().lower()] = value.strip()
+
+        path = target.split("?")[0]
+        keep = (
+            version == "HTTP/1.1"
+            and headers.get("connection", "").lower() != "close"
+        )
+
+        # bodies are ignored, but must be read past to find the next request
+        if "transfer-encoding" in headers:
+            keep = False
+        elif "content-length" in headers:
+            try:
+                length = int(headers["content-length"])
+            except ValueError:
+                length = -1
+
+            if not 0 <= length <= MAX_BODY:
+                self.respond(writer, 400, {"Connection": "close"})
+                return False
+
+            await reader.readexactly(length)
+
+        common = {"Connection": "keep-alive" if keep else "close"}
+
+        if method != "GET":
+            self.respond(writer, 405, dict(common, Allow="GET"))
+        elif path == "/hosts":
+            self.get_hosts(writer, headers, common)
+        elif path == "/events":
+            await self.get_events(writer)
+            return False
+        else:
+            self.respond(writer, 404, common)
+
+        return keep
+
+    def get_hosts(self, writer, headers, common) -> None:
+        etag = self.etag()
+        reply = dict(common)
+        reply["ETag"] = etag
+        reply["Cache-Control"] = "no-cache"
+
+        if headers.get("if-none-match") == etag:
+            self.not_modified += 1
+            self.respond(writer, 304, reply)
+            return
+
+        reply["Content-Type"] = "application/json"
+        self.respond(writer, 200, reply, self.snapshot())
+
+    async def get_events(self, writer: asyncio.StreamWriter) -> None:
+        writer.write(
+            b"HTTP/1.1 200 OK\r\n"
+            b"Content-Type: text/event-stream\r\n"
+            b"Cache-Control: no-cache\r\n"
+            b"Connection: close\r\n\r\n"
+        )
+        await writer.drain()
+
+        client = EventClient(writer, self.client_buffer)
+        task = asyncio.create_task(client.run())
+        self.clients[client] = task
+
+        # runs until the client disconnects, or is dropped
+        try:
+            await asyncio.wait([task])
+        finally:
+            task.cancel()
+            self.clients.pop(client, None)
+
+        if not task.cancelled() and task.exception() is not None:
+            log.debug("Event stream closed - {}".format(task.exception()))
@@ -0,0 +1,155 @@
+# Copyright (c) 2021 David Steele <dsteele@gmail.com>
+#
+# SPDX-License-Identifier: GPL-2.0-or-later
+# License-Filename: LICENSE
+
+
+import asyncio
+import itertools
+import os
+import socket
+import struct
+import time
+from typing import Dict, NamedTuple, Optional, Tuple
+
+ICMP_ECHO_REPLY = 0
+ICMP_ECHO_REQUEST = 8
+
+_header = struct.Struct("!BBHHH")
+
+
+class EchoReply(NamedTuple):
+    ident: int
+    seq: int
+
+
+def checksum(data: bytes) -> int:
+    if len(data) % 2:
+        data += b"\x00"
+
+    total = sum(struct.unpack("!{}H".format(len(data) // 2), data))
+    total = (total >> 16) + (total & 0xFFFF)
+    total += total >> 16
+
+    return ~total & 0xFFFF
+
+
+def build_echo(
+    ident: int, seq: int, payload: bytes = b"comitup-watch"
+) -> bytes:
+    header = _header.pack(ICMP_ECHO_REQUEST, 0, 0, ident, seq)
+    csum = checksum(header + payload)
+
+    return _header.pack(ICMP_ECHO_REQUEST, 0, csum, ident, seq) + payload
+
+
+def parse_echo_reply(data: bytes, raw: bool) -> Optional[EchoReply]:
+    """Extract the id/sequence from an echo reply, or None if not one."""
+    if raw:
+        if not data:
+            return None
+        data = data[(data[0] & 0x0F) * 4 :]
+
+    if len(data) < _header.size:
+        return None
+
+    icmp_type, _, _, ident, seq = _header.unpack_from(data)
+    if icmp_type != ICMP_ECHO_REPLY:
+        return None
+
+    return EchoReply(ident, seq)
+
+
+class IcmpPinger:
+    """ICMP echo client multiplexing any number of probes on one socket.
+
+    An unprivileged SOCK_DGRAM ICMP socket is used where the kernel permits
+    it (net.ipv4.ping_group_range), with a fallback to a raw socket. Replies
+    are read from the event loop and matched to probes by id and sequence.
+    """
+
+    def __init__(self):
+        self.sock: Optional[socket.socket] = None
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.raw = False
+        self.ident = 0
+        self._seq = itertools.count()
+        self._pending: Dict[Tuple[str, int], Tuple[float, asyncio.Future]] = {}
+
+    def open(self) -> bool:
+        """Open the ICMP socket, returning False if that isn't allowed."""
+        for kind, raw in [(socket.SOCK_DGRAM, False), (socket.SOCK_RAW, True)]:
+            try:
+                sock = socket.socket(socket.AF_INET, kind, socket.IPPROTO_ICMP)
+                break
+            except OSError:
+                pass
+        else:
+            return False
+
+        sock.setblocking(False)
+        self.sock = sock
+        self.raw = raw
+
+        if raw:
+            self.ident = os.getpid() & 0xFFFF
+        else:
+            # the kernel rewrites the id field with the socket "port"
+            sock.bind(("0.0.0.0", 0))
+            self.ident = sock.getsockname()[1]
+
+        self.loop = asyncio.get_event_loop()
+        self.loop.add_reader(sock.fileno(), self._on_readable)
+
+        return True
+
+    def close(self) -> None:
+        if self.sock is None:
+            return
+
+        if not self.loop.is_closed():
+            self.loop.remove_reader(self.sock.fileno())
+        self.sock.close()
+        self.sock = None
+
+        for _, fut in self._pending.values():
+            if not fut.done():
+                fut.set_result(None)
+        self._pending.clear()
+
+    def _on_readable(self) -> None:
+        while self.sock is not None:
+            try:
+                data, addr = self.sock.recvfrom(2048)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError:
+                return
+
+            reply = parse_echo_reply(data, self.raw)
+            if reply is None or reply.ident != self.ident:
+                continue
+
+            entry = self._pending.pop((addr[0], reply.seq), None)
+            if entry is not None:
+                sent, fut = entry
+                if not fut.done():
+                    fut.set_result(time.monotonic() - sent)
+
+    async def ping(self, ip: str, timeout: float) -> Optional[float]:
+        """Send one echo request, returning the RTT in seconds or None."""
+        if self.sock is None:
+            return None
+
+        seq = next(self._seq) & 0xFFFF
+        fut = self.loop.create_future()
+        key = (ip, seq)
+        self._pending[key] = (time.monotonic(), fut)
+
+        try:
+            self.sock.sendto(build_echo(self.ident, seq), (ip, 0))
+            return await asyncio.wait_for(fut, timeout=timeout)
+        except (OSError, asyncio.TimeoutError):
+            return None
+        finally:
+            self._pending.pop(key, None)
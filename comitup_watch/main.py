@@ -4,39 +4,274 @@
 # License-Filename: LICENSE
 
 
+import argparse
 import asyncio
+import functools
+import json
+import sys
+import time
 
-import ravel
+from . import comitup_mon, httpapi, ndjson, pingmon
 
-from . import avahi_watch, comitup_mon, devicemon, pingmon
+# zeroconf and the D-Bus modules are imported as their sources start, so
+# that the first frame isn't held up by them
 
 
-async def main_async(bus):
+def address(text: str):
+    # named for the argparse error message
+    return httpapi.parse_address(text)
 
-    comitupmon = comitup_mon.ComitupMon()
-    event_queue = comitupmon.event_queue()
-    ping_queue = comitupmon.ping_queue()
 
-    devmon = devicemon.DeviceMonitor(bus, event_queue)
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        prog="comitup-watch",
+        description="Monitor local Comitup-enabled devices",
+    )
+    parser.add_argument(
+        "--ping-limit",
+        type=int,
+        default=pingmon.DEFAULT_LIMIT,
+        help="maximum number of pings in flight (default %(default)s)",
+    )
+    parser.add_argument(
+        "--scan-interval",
+        type=float,
+        default=10,
+        help="minimum seconds between WiFi scan requests, or 0 to disable"
+        " (default %(default)s)",
+    )
+    parser.add_argument(
+        "-i",
+        "--interface",
+        action="append",
+        default=[],
+        metavar="IFACE",
+        help="browse for devices on this interface only (repeatable)",
+    )
+    parser.add_argument(
+        "--ip-version",
+        choices=["4", "6", "all"],
+        help="IP version(s) to browse for devices on",
+    )
+    parser.add_argument(
+        "--max-fps",
+        type=float,
+        default=10,
+        help="maximum screen updates per second (default %(default)s)",
+    )
+    parser.add_argument(
+        "--ndjson",
+        nargs="?",
+        const="-",
+        type=argparse.FileType("a", encoding="utf-8"),
+        metavar="FILE",
+        help="write changes as JSON lines to FILE (default stdout), instead"
+        " of showing the display",
+    )
+    parser.add_argument(
+        "--once",
+        action="store_true",
+        help="print the devices found once discovery settles, and exit",
+    )
+    parser.add_argument(
+        "--json",
+        action="store_true",
+        help="print the --once snapshot as JSON",
+    )
+    parser.add_argument(
+        "--quiet",
+        type=float,
+        default=0.5,
+        metavar="SECONDS",
+        help="with --once, the time without changes that counts as settled"
+        " (default %(default)s)",
+    )
+    parser.add_argument(
+        "--deadline",
+        type=float,
+        default=10,
+        metavar="SECONDS",
+        help="with --once, the longest time to run (default %(default)s)",
+    )
+
+    parser.add_argument(
+        "--http",
+        type=address,
+        metavar="[HOST:]PORT",
+        help="serve the device list over HTTP, on HOST (default"
+        " {}) and PORT".format(httpapi.DEFAULT_HOST),
+    )
+
+    args = parser.parse_args(argv)
+
+    if args.json and not args.once:
+        parser.error("--json requires --once")
+
+    if args.interface:
+        from . import avahi_watch
+
+        try:
+            avahi_watch.interface_addrs(args.interface, args.ip_version)
+        except ValueError as e:
+            parser.error(str(e))
+
+    return args
+
+
+async def start_devicemon(event_queue, args) -> None:
+    import ravel
+
+    from . import devicemon
+
+    bus = ravel.system_bus()
+    bus.attach_asyncio(asyncio.get_event_loop())
+
+    devmon = devicemon.DeviceMonitor(
+        bus, event_queue, scan_interval=args.scan_interval
+    )
     await devmon.startup()
 
-    avahimon = asyncio.create_task(avahi_watch.amain(event_queue))  # noqa
-    ping_mon = asyncio.create_task(  # noqa
-        pingmon.amain(event_queue, ping_queue, comitupmon.clist)
+
+async def start_avahi(event_queue, args, ready=None) -> None:
+    from . import avahi_watch
+
+    await avahi_watch.amain(
+        event_queue,
+        interfaces=args.interface,
+        ip_version=args.ip_version,
+        ready=ready,
     )
 
-    await comitupmon.run()
+
+def source_done(log, failures, name, task) -> None:
+    if not task.cancelled() and task.exception() is not None:
+        log.error("{} source failed - {}".format(name, task.exception()))
+        failures[name] = task.exception()
+
+
+async def print_snapshot(comitupmon, args, ready, failures) -> bool:
+    """Wait for discovery to settle, or the deadline, and print the hosts.
+
+    Source failures, and a missed deadline, are reported on stderr. Returns
+    True if the snapshot is complete.
+    """
+    monitor = asyncio.create_task(comitupmon.run())
+
+    try:
+        settled = await comitupmon.wait_quiet(args.quiet, args.deadline, ready)
+    finally:
+        monitor.cancel()
+        await asyncio.wait([monitor])
+
+    if not settled:
+        comitupmon.log.warning("Snapshot deadline reached before settling")
+
+    if args.json:
+        print(json.dumps(comitupmon.clist.snapshot(), indent=2))
+    else:
+        print("\n".join(comitupmon.snapshot_lines()))
+
+    for name, exc in failures.items():
+        print("{} source failed - {}".format(name, exc), file=sys.stderr)
+    if not settled:
+        print("Snapshot deadline reached before settling", file=sys.stderr)
+
+    return settled and not failures
+
+
+async def main_async(args, started=None) -> int:
+    """Run the monitor, returning the exit status."""
+    comitupmon = comitup_mon.ComitupMon(
+        max_fps=args.max_fps,
+        started=started,
+        render=args.ndjson is None and not args.once,
+    )
+
+    writer = None
+    if args.ndjson is not None:
+        writer = ndjson.NdjsonWriter(args.ndjson)
+        comitupmon.add_sink(writer)
+
+    event_queue = comitupmon.event_queue()
+    ping_queue = comitupmon.ping_queue()
+
+    server = None
+    if args.http is not None:
+        server = httpapi.StatusServer(comitupmon, *args.http)
+        await server.start()
+
+    avahi_ready = asyncio.Event()
+
+    if args.once:
+        pinger = pingmon.PingPass(
+            event_queue, ping_queue, comitupmon.clist, limit=args.ping_limit
+        )
+        ping_source = pinger.run()
+    else:
+        ping_source = pingmon.amain(
+            event_queue, ping_queue, comitupmon.clist, limit=args.ping_limit
+        )
+
+    # start every source at once, and show whatever arrives first
+    sources = {
+        "NetworkManager": start_devicemon(event_queue, args),
+        "Zeroconf": start_avahi(event_queue, args, avahi_ready),
+        "Ping": ping_source,
+    }
+    tasks = {}
+    failures = {}
+    for name, coro in sources.items():
+        task = asyncio.create_task(coro)
+        task.add_done_callback(
+            functools.partial(source_done, comitupmon.log, failures, name)
+        )
+        tasks[name] = task
+
+    def ready() -> bool:
+        return (
+            tasks["NetworkManager"].done()
+            and (avahi_ready.is_set() or tasks["Zeroconf"].done())
+            and pinger.idle()
+        )
+
+    try:
+        if args.once:
+            complete = await print_snapshot(comitupmon, args, ready, failures)
+            return 0 if complete else 1
+
+        await comitupmon.run()
+        return 0
+    finally:
+        for task in tasks.values():
+            task.cancel()
+
+        # let the sources close their sockets
+        await asyncio.wait(tasks.values(), timeout=1.0)
+
+        if writer is not None:
+            writer.close()
+
+        if server is not None:
+            await server.close()
 
 
 def main():
-    loop = asyncio.get_event_loop()
+    started = time.monotonic()
+    args = parse_args()
 
-    bus = ravel.system_bus()
-    bus.attach_asyncio(loop)
+    loop = asyncio.get_event_loop()
 
-    loop.create_task(main_async(bus))
+    task = loop.create_task(main_async(args, started))
     try:
-        loop.run_forever()
+        if args.once:
+            sys.exit(loop.run_until_complete(task))
+        else:
+            loop.run_forever()
     except KeyboardInterrupt:
-        print("\x1b[?25h")
-        print("\r  ")
+        # let the monitor, and any event stream, shut down cleanly
+        task.cancel()
+        loop.run_until_complete(asyncio.gather(task, return_exceptions=True))
+
+        if args.ndjson is None and not args.once:
+            print("\x1b[?25h")
+            print("\r  ")
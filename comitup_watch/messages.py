@@ -0,0 +1,52 @@
+# Copyright (c) 2021 David Steele <dsteele@gmail.com>
+#
+# SPDX-License-Identifier: GPL-2.0-or-later
+# License-Filename: LICENSE
+
+"""Event messages passed from the sources to the monitor.
+
+These are kept apart from the sources, so that the monitor can be loaded,
+and draw its first frame, without importing zeroconf or the D-Bus modules.
+
+REFRESHED messages periodically confirm that unchanged data is still
+current, so that the monitor can evict data that is no longer confirmed.
+"""
+
+from enum import Enum
+from typing import NamedTuple
+
+
+class AvahiAction(Enum):
+    ADDED = "ADDED"
+    REMOVED = "REMOVED"
+    REFRESHED = "REFRESHED"
+
+
+class AvahiMessage(NamedTuple):
+    action: AvahiAction
+    key: str
+    # name: str
+    host: str
+    ipv4: str
+    ipv6: str
+
+
+class DeviceMonAction(Enum):
+    ADDED = "ADDED"
+    REMOVED = "REMOVED"
+    REFRESHED = "REFRESHED"
+
+
+class DeviceMonMsg(NamedTuple):
+    action: DeviceMonAction
+    ssid: str
+
+
+class PingAction(Enum):
+    ADDED = "ADDED"
+    REMOVED = "REMOVED"
+
+
+class PingMessage(NamedTuple):
+    action: PingAction
+    name: str
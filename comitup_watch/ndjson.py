@@ -0,0 +1,94 @@
+# Copyright (c) 2021 David Steele <dsteele@gmail.com>
+#
+# SPDX-License-Identifier: GPL-2.0-or-later
+# License-Filename: LICENSE
+
+
+import asyncio
+import json
+import logging
+import sys
+from typing import Any, Dict, List, Optional, TextIO
+
+FLUSH_INTERVAL = 0.5
+BUFFER_SIZE = 64 * 1024
+
+log = logging.getLogger("comitup-watch")
+
+
+class NdjsonWriter:
+    """Write events as JSON lines, buffered, and flushed periodically.
+
+    Lines are collected in memory, and written out with a single write once
+    'buffer_size' characters are pending, or 'flush_interval' seconds after
+    the first pending line, whichever is sooner. If the reader goes away,
+    further events are dropped.
+    """
+
+    def __init__(
+        self,
+        out: TextIO,
+        flush_interval: float = FLUSH_INTERVAL,
+        buffer_size: int = BUFFER_SIZE,
+    ) -> None:
+        self.out: Optional[TextIO] = out
+        self.flush_interval = flush_interval
+        self.buffer_size = buffer_size
+
+        self.pending: List[str] = []
+        self.pending_size = 0
+        self.flush_handle: Optional[asyncio.TimerHandle] = None
+
+        self.encode = json.JSONEncoder(separators=(",", ":")).encode
+
+        self.lines = 0
+        self.writes = 0
+
+    def __call__(self, event: Dict[str, Any]) -> None:
+        self.write(event)
+
+    def write(self, event: Dict[str, Any]) -> None:
+        if self.out is None:
+            return
+
+        line = self.encode(event)
+        self.pending.append(line)
+        self.pending_size += len(line) + 1
+        self.lines += 1
+
+        if self.pending_size >= self.buffer_size:
+            self.flush()
+        elif self.flush_handle is None:
+            loop = asyncio.get_event_loop()
+            self.flush_handle = loop.call_later(
+                self.flush_interval, self.flush
+            )
+
+    def flush(self) -> None:
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+
+        if not self.pending or self.out is None:
+            return
+
+        text = "\n".join(self.pending) + "\n"
+        self.pending = []
+        self.pending_size = 0
+
+        try:
+            self.out.write(text)
+            self.out.flush()
+        except BrokenPipeError:
+            log.warning("Event stream closed by the reader")
+            self.out = None
+            return
+
+        self.writes += 1
+
+    def close(self) -> None:
+        self.flush()
+
+        if self.out is not None and self.out is not sys.stdout:
+            self.out.close()
+        self.out = None
@@ -1,46 +1,179 @@
 import asyncio
-from datetime import datetime, timedelta
-from enum import Enum
+import functools
+import heapq
+import itertools
+import logging
+import time
 from subprocess import DEVNULL
-from typing import NamedTuple, Optional
+from typing import Dict, List, Optional, Set, Tuple
 
+from .icmp import IcmpPinger
+from .messages import PingAction, PingMessage
 
-class PingAction(Enum):
-    ADDED = "ADDED"
-    REMOVED = "REMOVED"
+DEFAULT_LIMIT = 32
 
+log = logging.getLogger("comitup-watch")
 
-class PingMessage(NamedTuple):
-    action: PingAction
-    name: str
 
+class HostSchedule:
+    __slots__ = ["due", "token", "interval", "status"]
 
-async def ping_host(period: int, request_q: asyncio.Queue, clist):
-    """Yield hosts for periodic ping, with priority to a request queue."""
-    timestamp = None
+    def __init__(self, interval: float) -> None:
+        self.due = 0.0
+        self.token = 0
+        self.interval = interval
+        self.status: Optional[bool] = None
 
-    while True:
-        now = datetime.now()
 
-        if timestamp is None:
-            timestamp = now
+class PingScheduler:
+    """Hand out hosts to ping as they come due, via a heap of due times.
 
-        if timestamp > now:
-            delay = timestamp - now
-            try:
-                host = await asyncio.wait_for(
-                    request_q.get(), timeout=delay.total_seconds()
+    Hosts that change state are re-probed after 'fast' seconds. Hosts that
+    stay up, or stay down, have their interval doubled from 'period' up to
+    'max_up' or 'max_down', respectively. Hosts on the request queue are
+    returned ahead of anything else. Hosts are picked up from, and dropped
+    with, the clist once per period.
+    """
+
+    def __init__(
+        self,
+        request_q: asyncio.Queue,
+        clist,
+        period: float = 10,
+        fast: float = 0.5,
+        max_up: float = 60,
+        max_down: float = 300,
+    ) -> None:
+        self.request_q = request_q
+        self.clist = clist
+        self.period = period
+        self.fast = fast
+        self.max_up = max_up
+        self.max_down = max_down
+
+        self.heap: List[Tuple[float, int, str]] = []
+        self.hosts: Dict[str, HostSchedule] = {}
+        self.counter = itertools.count()
+        # set when a host comes due sooner than the one being waited on
+        self.wake = asyncio.Event()
+
+        self.reconcile_due = 0.0
+        self.late = 0
+        self.max_late = 0.0
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> str:
+        return await self.next()
+
+    def _push(self, hostname: str, due: float) -> None:
+        sched = self.hosts[hostname]
+        sched.due = due
+        sched.token = next(self.counter)
+        heapq.heappush(self.heap, (due, sched.token, hostname))
+
+    def _is_stale(self, entry: Tuple[float, int, str]) -> bool:
+        sched = self.hosts.get(entry[2])
+        return sched is None or sched.token != entry[1]
+
+    def add(self, hostname: str, due: float) -> None:
+        if hostname not in self.hosts:
+            self.hosts[hostname] = HostSchedule(self.period)
+        self._push(hostname, due)
+
+    def reconcile(self, now: float) -> None:
+        """Sync the scheduled hosts with the clist, and report lateness."""
+        current = set()
+        for host in self.clist:
+            current.add(host.host)
+            if host.host not in self.hosts:
+                self.add(host.host, now)
+
+        for hostname in set(self.hosts) - current:
+            del self.hosts[hostname]
+
+        if len(self.heap) > 2 * len(self.hosts) + 64:
+            self.heap = [x for x in self.heap if not self._is_stale(x)]
+            heapq.heapify(self.heap)
+
+        if self.late:
+            log.warning(
+                "{} pings were late, by up to {:.1f}s".format(
+                    self.late, self.max_late
                 )
-                yield host
-            except asyncio.TimeoutError:
-                pass
+            )
+            self.late = 0
+            self.max_late = 0.0
+
+        self.reconcile_due = now + self.period
+
+    def record(self, hostname: str, status: bool) -> None:
+        """Set the next due time for a host, based on a ping result."""
+        sched = self.hosts.get(hostname)
+        if sched is None:
+            return
+
+        if status != sched.status:
+            sched.interval = self.fast
         else:
-            timestamp = timestamp + timedelta(seconds=period)
-            for host in [x.host for x in clist]:
-                while not request_q.empty():
-                    yield await request_q.get()
+            limit = self.max_up if status else self.max_down
+            sched.interval = min(max(2 * sched.interval, self.period), limit)
+
+        sched.status = status
+        due = time.monotonic() + sched.interval
+        if not self.heap or due < self.heap[0][0]:
+            self.wake.set()
+        self._push(hostname, due)
+
+    def _take(self, hostname: str, now: float) -> str:
+        sched = self.hosts.get(hostname)
+        interval = sched.interval if sched else self.period
+
+        # provisional, until the result is recorded
+        self.add(hostname, now + interval)
+
+        return hostname
+
+    async def next(self) -> str:
+        while True:
+            self.wake.clear()
+            now = time.monotonic()
+
+            if not self.request_q.empty():
+                return self._take(self.request_q.get_nowait(), now)
+
+            if now >= self.reconcile_due:
+                self.reconcile(now)
+
+            while self.heap and self._is_stale(self.heap[0]):
+                heapq.heappop(self.heap)
+
+            if self.heap and self.heap[0][0] <= now:
+                due, _, hostname = heapq.heappop(self.heap)
+                if now - due > 1.0:
+                    self.late += 1
+                    self.max_late = max(self.max_late, now - due)
+                return self._take(hostname, now)
+
+            due = self.reconcile_due
+            if self.heap:
+                due = min(due, self.heap[0][0])
+
+            getter = asyncio.ensure_future(self.request_q.get())
+            waker = asyncio.ensure_future(self.wake.wait())
+            try:
+                await asyncio.wait(
+                    [getter, waker],
+                    timeout=due - now,
+                    return_when=asyncio.FIRST_COMPLETED,
+                )
+            finally:
+                waker.cancel()
+                getter.cancel()
 
-                yield host
+            if getter.done() and not getter.cancelled():
+                return self._take(getter.result(), time.monotonic())
 
 
 def get_host_ip(hostname: str, clist) -> Optional[str]:
@@ -48,32 +181,127 @@ def get_host_ip(hostname: str, clist) -> Optional[str]:
 
     host = clist.get_host(hostname)
 
-    if host:
+    # hosts that stopped answering are left alone, until re-announced
+    if host and not host.ping_evicted:
         ip = host.ipv4
     return ip
 
 
-async def ping(ip: str) -> bool:
+_pinger: Optional[IcmpPinger] = None
+_pinger_failed = False
+
+
+def get_pinger() -> Optional[IcmpPinger]:
+    """Return the shared in-process ICMP engine, if a socket is allowed."""
+    global _pinger, _pinger_failed
+
+    if _pinger is not None and _pinger.loop is not asyncio.get_event_loop():
+        _pinger.close()
+        _pinger = None
+
+    if _pinger is None and not _pinger_failed:
+        pinger = IcmpPinger()
+        if pinger.open():
+            _pinger = pinger
+        else:
+            _pinger_failed = True
+
+    return _pinger
+
+
+async def ping_subprocess(ip: str, timeout: float = 0.4) -> bool:
     cmd = "ping -c 1 " + ip
     proc = await asyncio.create_subprocess_exec(
         *cmd.split(), stdout=DEVNULL, stderr=DEVNULL
     )
     try:
-        return_code = await asyncio.wait_for(proc.wait(), timeout=0.4)
+        return_code = await asyncio.wait_for(proc.wait(), timeout=timeout)
     except asyncio.TimeoutError:
+        proc.kill()
+        await proc.wait()
         return False
 
     return return_code == 0
 
 
-async def amain(event_q, req_q, clist):
+async def ping(ip: str, timeout: float = 0.4) -> bool:
+    pinger = get_pinger()
 
-    async for hostname in ping_host(10, req_q, clist):
-        ip = get_host_ip(hostname, clist)
+    if pinger is not None:
+        return await pinger.ping(ip, timeout) is not None
 
-        if ip and await ping(ip):
-            msg = PingMessage(PingAction.ADDED, hostname)
-        else:
-            msg = PingMessage(PingAction.REMOVED, hostname)
+    return await ping_subprocess(ip, timeout)
+
+
+async def probe(hostname: str, event_q, clist) -> bool:
+    ip = get_host_ip(hostname, clist)
+
+    status = bool(ip) and await ping(ip)
+    if status:
+        msg = PingMessage(PingAction.ADDED, hostname)
+    else:
+        msg = PingMessage(PingAction.REMOVED, hostname)
+
+    await event_q.put(msg)
+
+    return status
+
+
+async def amain(event_q, req_q, clist, period=10, limit=DEFAULT_LIMIT):
+    """Ping hosts as they come due, with up to 'limit' probes in flight."""
+    slots = asyncio.Semaphore(limit)
+    tasks = set()
+    scheduler = PingScheduler(req_q, clist, period)
+
+    def done(hostname, task):
+        tasks.discard(task)
+        slots.release()
+
+        if not task.cancelled() and task.exception() is None:
+            scheduler.record(hostname, task.result())
+
+    while True:
+        # take a slot before choosing the host, so requests keep priority
+        await slots.acquire()
+        hostname = await scheduler.next()
+
+        task = asyncio.create_task(probe(hostname, event_q, clist))
+        tasks.add(task)
+        task.add_done_callback(functools.partial(done, hostname))
+
+
+class PingPass:
+    """Ping each requested host once, with up to 'limit' probes in flight.
+
+    This is the single pass used for a snapshot - hosts are pinged as soon
+    as their addresses are announced, rather than on a schedule.
+    """
+
+    def __init__(self, event_q, req_q, clist, limit=DEFAULT_LIMIT) -> None:
+        self.event_q = event_q
+        self.req_q = req_q
+        self.clist = clist
+        self.slots = asyncio.Semaphore(limit)
+
+        self.pinged: Set[str] = set()
+        self.tasks: Set[asyncio.Task] = set()
+
+    def idle(self) -> bool:
+        """Return True if no hosts are waiting to be pinged."""
+        return not self.tasks and self.req_q.empty()
+
+    async def probe(self, hostname: str) -> None:
+        async with self.slots:
+            await probe(hostname, self.event_q, self.clist)
+
+    async def run(self) -> None:
+        while True:
+            hostname = await self.req_q.get()
+            if hostname in self.pinged:
+                continue
+
+            self.pinged.add(hostname)
 
-        await event_q.put(msg)
+            task = asyncio.create_task(self.probe(hostname))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
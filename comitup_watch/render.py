@@ -0,0 +1,159 @@
+# Copyright (c) 2021 David Steele <dsteele@gmail.com>
+#
+# SPDX-License-Identifier: GPL-2.0-or-later
+# License-Filename: LICENSE
+
+
+import re
+import sys
+import time
+from collections import Counter
+from typing import Dict, Hashable, Iterable, List, Optional, TextIO, Tuple
+
+CLEAR_SCREEN = "\x1b[H\x1b[2J"
+CLEAR_LINE = "\x1b[K"
+CLEAR_BELOW = "\x1b[J"
+
+MIN_PADDING = 2
+
+_ansi_re = re.compile(r"\x1b\[[0-9;]*m")
+
+
+def goto(row: int) -> str:
+    return "\x1b[{};1H".format(row + 1)
+
+
+def visible_len(text: str) -> int:
+    return len(_ansi_re.sub("", text))
+
+
+class TermRenderer:
+    """Draw frames of text lines, rewriting only the lines that changed.
+
+    The previous frame is kept, and each new frame is written as a set of
+    cursor-addressed line replacements, in a single write. Frames are
+    limited to 'max_fps' per second - see 'delay()'.
+    """
+
+    def __init__(self, out: Optional[TextIO] = None, max_fps: float = 10):
+        self.out = out if out is not None else sys.stdout
+        self.interval = 1.0 / max_fps if max_fps else 0.0
+        self.prev: Optional[List[str]] = None
+        self.last_frame = -self.interval
+        self.frames = 0
+        self.bytes = 0
+
+    def invalidate(self) -> None:
+        """Force the next frame to be drawn in full, e.g. after a resize."""
+        self.prev = None
+
+    def delay(self) -> float:
+        """Return the seconds remaining before another frame is allowed."""
+        return max(0.0, self.last_frame + self.interval - time.monotonic())
+
+    def diff(self, lines: List[str]) -> str:
+        if self.prev is None:
+            return CLEAR_SCREEN + "\n".join(
+                line + CLEAR_LINE for line in lines
+            )
+
+        chunks = [
+            goto(row) + line + CLEAR_LINE
+            for row, line in enumerate(lines)
+            if row >= len(self.prev) or self.prev[row] != line
+        ]
+
+        if len(lines) < len(self.prev):
+            chunks.append(goto(len(lines)) + CLEAR_BELOW)
+
+        return "".join(chunks)
+
+    def render(self, lines: List[str]) -> None:
+        text = self.diff(lines)
+        self.prev = list(lines)
+        self.last_frame = time.monotonic()
+
+        if text:
+            self.out.write(text)
+            self.out.flush()
+
+            self.frames += 1
+            self.bytes += len(text)
+
+
+class Table:
+    """Format keyed rows as aligned columns, caching each formatted line.
+
+    Column widths are tracked incrementally, with a count of the cell widths
+    in each column, so that changing a row costs the same no matter how many
+    rows there are. Lines are only reformatted when their row, or a column
+    width, changes.
+    """
+
+    def __init__(self, header: List[str]) -> None:
+        self.header = header
+        self.rows: Dict[Hashable, Tuple[str, ...]] = {}
+        self.cell_widths: Dict[Hashable, Tuple[int, ...]] = {}
+        self.width_counts = [Counter() for _ in header]
+        self.line_cache: Dict[Hashable, Tuple[Tuple[int, ...], str]] = {}
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def set_row(self, key: Hashable, cells: Iterable[str]) -> None:
+        cells = tuple(cells)
+        if self.rows.get(key) == cells:
+            return
+
+        self.remove_row(key)
+
+        widths = tuple(visible_len(x) for x in cells)
+        for counts, width in zip(self.width_counts, widths):
+            counts[width] += 1
+
+        self.rows[key] = cells
+        self.cell_widths[key] = widths
+
+    def remove_row(self, key: Hashable) -> None:
+        if key not in self.rows:
+            return
+
+        for counts, width in zip(self.width_counts, self.cell_widths[key]):
+            counts[width] -= 1
+            if not counts[width]:
+                del counts[width]
+
+        del self.rows[key]
+        del self.cell_widths[key]
+        self.line_cache.pop(key, None)
+
+    def widths(self) -> Tuple[int, ...]:
+        return tuple(
+            max([len(title) + MIN_PADDING] + list(counts))
+            for title, counts in zip(self.header, self.width_counts)
+        )
+
+    def format(self, cells: Iterable[str], widths: Tuple[int, ...]) -> str:
+        return "  ".join(
+            cell + " " * (width - visible_len(cell))
+            for cell, width in zip(cells, widths)
+        ).rstrip()
+
+    def line(self, key: Hashable, widths: Tuple[int, ...]) -> str:
+        cached = self.line_cache.get(key)
+        if cached is not None and cached[0] == widths:
+            return cached[1]
+
+        text = self.format(self.rows[key], widths)
+        self.line_cache[key] = (widths, text)
+
+        return text
+
+    def lines(self, keys: Iterable[Hashable]) -> List[str]:
+        """Return the header, rule and row lines, for rows in 'keys' order."""
+        widths = self.widths()
+
+        return [
+            self.format(self.header, widths),
+            "  ".join("-" * x for x in widths),
+        ] + [self.line(key, widths) for key in keys]
@@ -0,0 +1,231 @@
+import asyncio
+from typing import Any, NamedTuple
+from unittest.mock import AsyncMock, Mock
+
+import pytest
+
+from comitup_watch import avahi_watch
+from comitup_watch.avahi_watch import AvahiAction, MyListener
+
+
+class FakeInfo:
+    cached = False
+    active = 0
+    peak = 0
+
+    def __init__(self, tipe, name):
+        self.name = name
+        self.properties = {
+            b"hostname": name.split(".")[0].encode() + b".local",
+            b"ip6addr": b"",
+        }
+
+    def parsed_addresses(self):
+        return ["10.0.0.1", "fe80::1"]
+
+    def load_from_cache(self, zc):
+        return FakeInfo.cached
+
+    async def async_request(self, zc, timeout):
+        FakeInfo.active += 1
+        FakeInfo.peak = max(FakeInfo.peak, FakeInfo.active)
+        await asyncio.sleep(0.05)
+        FakeInfo.active -= 1
+        return True
+
+
+@pytest.fixture
+def listener(monkeypatch):
+    monkeypatch.setattr(avahi_watch, "AsyncServiceInfo", FakeInfo)
+    monkeypatch.setattr(FakeInfo, "cached", False)
+    monkeypatch.setattr(FakeInfo, "peak", 0)
+
+    return MyListener(Mock(), asyncio.Queue(), limit=4)
+
+def service(hostname):
+    return hostname + "._comitup._tcp.local."
+
+async def drain(q, count):
+    return [await asyncio.wait_for(q.get(), 1) for _ in range(count)]
+
+@pytest.mark.asyncio
+async def test_avahi_add(listener):
+    listener.add_service(None, None, service("foo"))
+
+    msg, = await drain(listener.q, 1)
+
+    assert msg.action == AvahiAction.ADDED
+    assert msg.host == "foo.local"
+    assert msg.ipv4 == "10.0.0.1"
+    assert msg.ipv6 == "fe80::1"
+    assert not listener.resolving
+
+@pytest.mark.asyncio
+async def test_avahi_concurrent_resolve(listener):
+    for index in range(12):
+        listener.add_service(None, None, service("host{}".format(index)))
+
+    msgs = await drain(listener.q, 12)
+
+    assert len({x.key for x in msgs}) == 12
+    assert FakeInfo.peak == 4
+
+@pytest.mark.asyncio
+async def test_avahi_cache_skips_request(listener, monkeypatch):
+    monkeypatch.setattr(FakeInfo, "cached", True)
+
+    listener.add_service(None, None, service("foo"))
+    await drain(listener.q, 1)
+
+    assert FakeInfo.peak == 0
+
+@pytest.mark.asyncio
+async def test_avahi_remove_cancels_resolve(listener):
+    listener.add_service(None, None, service("foo"))
+    await asyncio.sleep(0)
+    listener.remove_service(None, None, service("foo"))
+
+    msg, = await drain(listener.q, 1)
+    await asyncio.sleep(0.1)
+
+    assert msg.action == AvahiAction.REMOVED
+    assert listener.q.empty()
+
+@pytest.mark.asyncio
+async def test_avahi_dedupe(listener):
+    listener.add_service(None, None, service("foo"))
+    await drain(listener.q, 1)
+
+    listener.add_service(None, None, service("foo"))
+    listener.update_service(None, None, service("foo"))
+    await asyncio.sleep(0.1)
+
+    assert listener.q.empty()
+    assert listener.suppressed == 1
+
+class FakePtr(NamedTuple):
+    alias: str
+    expired: bool
+
+    def is_expired(self, now):
+        return self.expired
+
+@pytest.mark.asyncio
+async def test_avahi_refresh(listener):
+    for name in ["foo", "bar", "baz"]:
+        listener.add_service(None, None, service(name))
+    await drain(listener.q, 3)
+
+    listener.zc.cache.async_all_by_details.return_value = [
+        FakePtr(service("foo"), False),
+        FakePtr(service("bar"), True),
+        FakePtr(service("other"), False),
+    ]
+
+    assert listener.refresh() == 1
+
+    msg, = await drain(listener.q, 1)
+    assert msg.action == AvahiAction.REFRESHED
+    assert msg.key == service("foo")
+    assert msg.ipv4 == "10.0.0.1"
+
+@pytest.mark.asyncio
+async def test_avahi_update_changed(listener, monkeypatch):
+    listener.add_service(None, None, service("foo"))
+    await drain(listener.q, 1)
+
+    monkeypatch.setattr(
+        FakeInfo, "parsed_addresses", lambda self: ["10.0.0.2"]
+    )
+    listener.update_service(None, None, service("foo"))
+
+    msg, = await drain(listener.q, 1)
+
+    assert msg.action == AvahiAction.ADDED
+    assert msg.ipv4 == "10.0.0.2"
+    assert msg.ipv6 is None
+
+@pytest.mark.asyncio
+async def test_avahi_readd_after_remove(listener):
+    listener.add_service(None, None, service("foo"))
+    await drain(listener.q, 1)
+
+    listener.remove_service(None, None, service("foo"))
+    listener.add_service(None, None, service("foo"))
+
+    msgs = await drain(listener.q, 2)
+
+    assert [x.action for x in msgs] == [AvahiAction.REMOVED, AvahiAction.ADDED]
+
+class FakeIP(NamedTuple):
+    ip: Any
+    is_IPv4: bool
+
+    @property
+    def is_IPv6(self):
+        return not self.is_IPv4
+
+@pytest.fixture
+def adapters(monkeypatch):
+    eth0 = Mock(nice_name="eth0", index=2)
+    eth0.ips = [FakeIP("192.0.2.2", True), FakeIP(("fe80::1", 0, 2), False)]
+    docker0 = Mock(nice_name="docker0", index=3)
+    docker0.ips = [FakeIP("172.17.0.1", True)]
+
+    monkeypatch.setattr(
+        avahi_watch.ifaddr, "get_adapters", lambda: [eth0, docker0]
+    )
+
+@pytest.mark.parametrize(
+    "names, version, result",
+    [
+        (["eth0"], None, ["192.0.2.2"]),
+        (["eth0"], "4", ["192.0.2.2"]),
+        (["eth0"], "6", [2]),
+        (["eth0"], "all", ["192.0.2.2", 2]),
+        (["eth0", "docker0"], None, ["192.0.2.2", "172.17.0.1"]),
+    ],
+)
+def test_avahi_interface_addrs(adapters, names, version, result):
+    assert avahi_watch.interface_addrs(names, version) == result
+
+@pytest.mark.parametrize(
+    "names, version", [(["wlan9"], None), (["docker0"], "6")]
+)
+def test_avahi_interface_addrs_bad(adapters, names, version):
+    with pytest.raises(ValueError):
+        avahi_watch.interface_addrs(names, version)
+
+@pytest.mark.asyncio
+async def test_avahi_burst(listener, monkeypatch):
+    monkeypatch.setattr(avahi_watch, "BURST_SETTLE", 0)
+
+    zc = Mock()
+    zc.async_wait_for_start = AsyncMock()
+
+    def answer(out):
+        if zc.async_send.call_count == 1:
+            listener.add_service(None, None, service("foo"))
+
+    zc.async_send.side_effect = answer
+
+    elapsed = await avahi_watch.startup_burst(zc, listener, [0, 0.1, 0.2])
+
+    assert zc.async_send.call_count == 3
+    assert list(listener.known) == [service("foo")]
+    # resolved after 0.05s, well before the burst ended
+    assert 0.04 < elapsed < 0.1
+
+@pytest.mark.asyncio
+async def test_avahi_burst_empty(listener, monkeypatch):
+    monkeypatch.setattr(avahi_watch, "BURST_SETTLE", 0)
+
+    zc = Mock()
+    zc.async_wait_for_start = AsyncMock()
+
+    assert await avahi_watch.startup_burst(zc, listener, [0, 0.01]) == 0.0
+
+def test_avahi_ptr_query():
+    out = avahi_watch.ptr_query()
+
+    assert [x.name for x in out.questions] == [avahi_watch.SERVICE_TYPE]
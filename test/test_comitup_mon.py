@@ -4,9 +4,68 @@ from collections import namedtuple
 from typing import List
 from unittest.mock import Mock
 
-from comitup_watch.comitup_mon import ComitupHost, ComitupList, ComitupMon
+import asyncio
+import io
+import logging
+import math
+import time
+
+from comitup_watch.comitup_mon import (
+    ComitupHost,
+    ComitupList,
+    ComitupMon,
+    ExpiryMessage,
+    ExpiryTimer,
+    SweepMessage,
+)
 from comitup_watch.avahi_watch import AvahiAction, AvahiMessage
 from comitup_watch.devicemon import DeviceMonMsg, DeviceMonAction
+from comitup_watch.pingmon import PingAction, PingMessage
+
+##############################################################################
+# ExpiryTimer
+##############################################################################
+
+@pytest.mark.asyncio
+async def test_expiry_timer_collapses():
+    q = asyncio.Queue()
+    timer = ExpiryTimer(q, resolution=0.05)
+
+    for _ in range(100):
+        timer.schedule(0.01)
+
+    assert len(timer) == 1
+
+    msg = await asyncio.wait_for(q.get(), 1)
+    assert type(msg) == ExpiryMessage
+    assert q.empty()
+    assert len(timer) == 0
+
+@pytest.mark.asyncio
+async def test_expiry_timer_ticks():
+    q = asyncio.Queue()
+    timer = ExpiryTimer(q, resolution=0.05)
+
+    timer.schedule(0.12)
+    timer.schedule(0.01)
+
+    first = await asyncio.wait_for(q.get(), 1)
+    second = await asyncio.wait_for(q.get(), 1)
+
+    assert first.tick < second.tick
+
+@pytest.mark.asyncio
+async def test_host_update_schedules_expiry():
+    clist = ComitupList(asyncio.Queue(), Mock())
+    clist.timer.resolution = 3600
+    host = ComitupHost("foo", clist.q, Mock())
+    clist.add_host(host)
+
+    for _ in range(10):
+        host.add_nm(DeviceMonMsg(DeviceMonAction.ADDED, "foo"))
+
+    assert len(clist.timer) == 1
+    assert len(asyncio.all_tasks()) == 1
 
 ##############################################################################
 # ComitupHost
@@ -60,6 +119,47 @@ async def test_comituphost_dev_msg(chost, test_rm):
         assert chost.ssid is None
 
 
+@pytest.mark.asyncio
+async def test_comituphost_row_cache(chost):
+    row = chost.get_display_row()
+    assert chost.get_display_row() is row
+
+    chost.add_nm(DeviceMonMsg(DeviceMonAction.ADDED, "foo"))
+
+    assert chost.get_display_row() is not row
+    assert "foo" in chost.get_display_row()[0]
+
+@pytest.mark.asyncio
+async def test_comituphost_readd_unchanged(chost):
+    assert chost.add_nm(DeviceMonMsg(DeviceMonAction.ADDED, "foo"))
+    updated = chost.update_time("nm")
+    seen = chost.nm_seen
+
+    assert not chost.add_nm(DeviceMonMsg(DeviceMonAction.ADDED, "foo"))
+    assert chost.update_time("nm") == updated
+    assert chost.nm_seen >= seen
+
+def test_comituphost_slots(chost):
+    assert not hasattr(chost, "__dict__")
+
+    with pytest.raises(AttributeError):
+        chost.color = "green"
+
+def test_comituphost_is_new(chost, monkeypatch):
+    monkeypatch.setattr("comitup_watch.comitup_mon.start_time", -100.0)
+    assert not chost.is_new("nm")
+
+    chost.update("nm")
+    assert chost.is_new("nm")
+    assert not chost.is_new("ping")
+
+    monkeypatch.setattr(
+        "comitup_watch.comitup_mon.time.monotonic",
+        lambda: chost.update_time("nm") + 31,
+    )
+    assert not chost.is_new("nm")
+
+
 ##############################################################################
 # ComitupList
 ##############################################################################
@@ -103,11 +203,11 @@ OrderCase = namedtuple("OrderCase", ["input", "output", "index"])
     ],
 )
 def test_comituplist_add_host(clist, case):
-    index = clist.add_host(ComitupHost(case.input, Mock(), Mock()))
+    clist.add_host(ComitupHost(case.input, Mock(), Mock()))
 
     assert [x.host for x in clist.list] == case.output
 
-    assert index == case.index
+    assert clist._index(case.input) == case.index
 
 def test_comituplist_no_dups(clist):
     with pytest.raises(Exception):
@@ -133,6 +233,51 @@ def test_comituplist_rm_host(clist):
 def test_comituplist_get_item(clist, index):
     assert clist[index] == clist.list[index]
 
+def test_comituplist_iter(clist):
+    assert [x.host for x in clist] == ["bravo", "delta"]
+
+@pytest.mark.asyncio
+async def test_comituplist_attr_index(clist):
+    host = clist.get_host("delta")
+    host.add_avahi(AvahiMessage(AvahiAction.ADDED, "key", "host", "1.2.3.4", None))
+
+    assert clist.get_host_by_attr("ipv4", "1.2.3.4") is host
+    assert clist.get_host_by_attr("avahi_key", "key") is host
+
+    host.rm_avahi()
+
+    assert clist.get_host_by_attr("ipv4", "1.2.3.4") is None
+    assert clist.get_host_by_attr("avahi_key", "key") is None
+
+@pytest.mark.asyncio
+async def test_comituplist_rm_host_index(clist):
+    clist.get_host("bravo").add_nm(DeviceMonMsg(DeviceMonAction.ADDED, "bravo"))
+    assert clist.get_host_by_attr("ssid", "bravo").host == "bravo"
+
+    clist.rm_host("bravo")
+
+    assert clist.get_host_by_attr("ssid", "bravo") is None
+    assert clist.get_host("bravo") is None
+
+@pytest.mark.asyncio
+async def test_comituplist_dirty(clist):
+    clist.dirty.clear()
+
+    clist.get_host("delta").add_nm(DeviceMonMsg(DeviceMonAction.ADDED, "x"))
+
+    assert clist.dirty == {"delta"}
+
+    clist.rm_host("bravo")
+
+    assert clist.dirty == {"bravo", "delta"}
+
+def test_comituplist_expire_dirty(clist):
+    clist.dirty.clear()
+
+    clist.expire({"bravo", "zulu"})
+
+    assert clist.dirty == {"bravo"}
+
 ##############################################################################
 # ComitupMon
 ##############################################################################
@@ -234,3 +379,225 @@ async def test_comitupmon_add_and_del(com_mon):
 
     send_nm_msg(com_mon, "REMOVED", "host2")
     assert not host_exists(com_mon, "host2")
+
+@pytest.mark.asyncio
+async def test_comitupmon_batch(com_mon):
+    for index in range(50):
+        com_mon.q.put_nowait(
+            DeviceMonMsg(DeviceMonAction.ADDED, "ssid{}".format(index))
+        )
+
+    assert await com_mon.run_batch() == 50
+    assert len(com_mon.clist) == 52
+
+    assert com_mon.print_list.call_count == 1
+    assert com_mon.stats.last_size == 50
+    assert com_mon.stats.batches == 1
+
+@pytest.mark.asyncio
+async def test_comitupmon_batch_limit(com_mon):
+    com_mon.batch_limit = 10
+    for index in range(15):
+        com_mon.q.put_nowait(
+            DeviceMonMsg(DeviceMonAction.ADDED, "ssid{}".format(index))
+        )
+
+    assert await com_mon.run_batch() == 10
+    assert await com_mon.run_batch() == 5
+
+@pytest.mark.asyncio
+async def test_comitupmon_no_dirty_no_render(com_mon):
+    com_mon.clist.dirty.clear()
+    com_mon.q.put_nowait(ExpiryMessage(0))
+
+    await com_mon.run_batch()
+
+    assert com_mon.print_list.call_count == 0
+
+@pytest.mark.parametrize("budget, level", [(10.0, "INFO"), (0.0, "WARNING")])
+@pytest.mark.asyncio
+async def test_comitupmon_first_frame(monkeypatch, caplog, budget, level):
+    monkeypatch.setattr("comitup_watch.comitup_mon.ComitupHost.update", Mock())
+
+    com_mon = ComitupMon(first_frame_budget=budget)
+    com_mon.renderer.out = io.StringIO()
+
+    com_mon.print_list()
+    assert com_mon.first_frame is None
+
+    send_nm_msg(com_mon, "ADDED", "host1")
+    with caplog.at_level("INFO", logger="comitup-watch"):
+        com_mon.print_list()
+
+    first = com_mon.first_frame
+    assert first is not None and first >= 0
+    assert any(
+        x.levelname == level and "First device" in x.message
+        for x in caplog.records
+    )
+
+    send_nm_msg(com_mon, "ADDED", "host2")
+    com_mon.print_list()
+    assert com_mon.first_frame == first
+
+@pytest.mark.asyncio
+async def test_comitupmon_sweep(com_mon):
+    com_mon.ttls["ping"] = math.inf
+    now = time.monotonic()
+
+    com_mon.sweep(now)
+    assert len(com_mon.clist) == 2
+
+    com_mon.sweep(now + 1000)
+
+    assert len(com_mon.clist) == 0
+    assert com_mon.evictions == {"nm": 1, "avahi": 1, "hosts": 2}
+    assert com_mon.eviction_summary() == "nm: 1, avahi: 1, ping: 0, hosts: 2"
+
+@pytest.mark.asyncio
+async def test_comitupmon_sweep_refreshed(com_mon):
+    com_mon.ttls["ping"] = math.inf
+    com_mon.clist.get_host("host1").avahi_seen -= 1000
+    com_mon.clist.get_host("host2").nm_seen -= 1000
+
+    send_avahi_msg(com_mon, "REFRESHED", "host1")
+    send_nm_msg(com_mon, "REFRESHED", "host2")
+
+    com_mon.sweep(time.monotonic())
+
+    assert len(com_mon.clist) == 2
+    assert not com_mon.evictions
+
+@pytest.mark.asyncio
+async def test_comitupmon_evict_reannounce(com_mon):
+    com_mon.ttls["ping"] = math.inf
+    com_mon.sweep(time.monotonic() + 1000)
+    assert not host_exists(com_mon, "host1")
+
+    # the listener doesn't repeat an unchanged ADDED, but keeps refreshing
+    send_avahi_msg(com_mon, "REFRESHED", "host1")
+    send_nm_msg(com_mon, "REFRESHED", "host3")
+
+    host = com_mon.clist.get_host("host1")
+    assert host.ipv4 == "ipv4-host1"
+    assert host.avahi_key == "host1._comitup._tcp.local"
+    assert com_mon.clist.get_host("host3").ssid == "host3"
+
+@pytest.mark.asyncio
+async def test_comitupmon_sweep_unpingable(com_mon):
+    send_nm_msg(com_mon, "ADDED", "host1")
+    host = com_mon.clist.get_host("host1")
+    host.ping_seen = time.monotonic() - 5000
+
+    com_mon.q.put_nowait(SweepMessage(time.monotonic()))
+    await com_mon.run_batch()
+
+    assert host.ipv4 == "ipv4-host1"
+    assert host.ssid == "host1"
+    assert host.ping_evicted
+    assert host.ping_status is None
+    assert com_mon.evictions == {"ping": 1}
+    assert "Evicted - nm: 0, avahi: 0, ping: 1" in com_mon.get_frame()[2]
+
+    # evicted once, and not again until re-announced
+    com_mon.sweep(time.monotonic())
+    assert com_mon.evictions == {"ping": 1}
+
+    send_avahi_msg(com_mon, "REMOVED", "host1")
+    send_avahi_msg(com_mon, "ADDED", "host1")
+    assert not host.ping_evicted
+
+@pytest.mark.asyncio
+async def test_comitupmon_logs_stats_on_sweep(com_mon, caplog):
+    caplog.set_level(logging.INFO, logger="comitup-watch")
+    com_mon.stats.record(3, 0.002)
+
+    com_mon._sweep_due()
+    assert "Event batches - 3 events in 1 batches" in caplog.text
+
+    # nothing new to report
+    caplog.clear()
+    com_mon._sweep_due()
+    com_mon.sweep_handle.cancel()
+
+    assert "Event batches" not in caplog.text
+    assert com_mon.q.qsize() == 2
+
+@pytest.mark.asyncio
+async def test_comitupmon_sink(com_mon):
+    events = []
+    com_mon.add_sink(events.append)
+
+    com_mon.proc_msg(DeviceMonMsg(DeviceMonAction.ADDED, "host3"))
+    com_mon.proc_msg(DeviceMonMsg(DeviceMonAction.ADDED, "host3"))
+    com_mon.proc_msg(DeviceMonMsg(DeviceMonAction.REMOVED, "host3"))
+
+    assert [(x["host"], x["source"], x["changes"]) for x in events] == [
+        ("host3", "nm", {"ssid": "host3"}),
+        ("host3", "nm", {"ssid": None}),
+    ]
+    assert "removed" not in events[0]
+    assert events[1]["removed"]
+    assert events[0]["t"] <= events[1]["t"]
+
+@pytest.mark.asyncio
+async def test_comitupmon_sink_unknown_host(com_mon):
+    events = []
+    com_mon.add_sink(events.append)
+
+    com_mon.proc_msg(PingMessage(PingAction.REMOVED, "ghost"))
+    com_mon.proc_msg(PingMessage(PingAction.ADDED, "ghost"))
+    com_mon.proc_msg(DeviceMonMsg(DeviceMonAction.REMOVED, "ghost"))
+    send_avahi_msg(com_mon, "REMOVED", "ghost")
+    com_mon.emit_changes("avahi")
+
+    assert events == []
+    assert not host_exists(com_mon, "ghost")
+
+@pytest.mark.asyncio
+async def test_comitupmon_no_render(com_mon):
+    com_mon.render = False
+
+    com_mon.q.put_nowait(DeviceMonMsg(DeviceMonAction.ADDED, "host3"))
+    await com_mon.run_batch()
+
+    assert com_mon.print_list.call_count == 0
+    assert not com_mon.clist.dirty
+
+def test_comitupmon_snapshot(com_mon):
+    assert com_mon.clist.snapshot() == [
+        {
+            "host": "host1",
+            "ssid": None,
+            "domain": "host1.local",
+            "ipv4": "ipv4-host1",
+            "ipv6": "ipv6-host1",
+            "ping": None,
+        },
+        {
+            "host": "host2",
+            "ssid": "host2",
+            "domain": None,
+            "ipv4": None,
+            "ipv6": None,
+            "ping": None,
+        },
+    ]
+
+    lines = com_mon.snapshot_lines()
+    assert len(lines) == 4
+    assert lines[2].split() == ["host1.local", "ipv4-host1", "ipv6-host1"]
+    assert "\x1b" not in "".join(lines)
+
+@pytest.mark.asyncio
+async def test_comitupmon_wait_quiet(com_mon):
+    com_mon.started = time.monotonic()
+    com_mon.last_event = com_mon.started
+    ready = []
+
+    start = time.monotonic()
+    assert await com_mon.wait_quiet(0.05, 1.0, lambda: True)
+    assert time.monotonic() - start < 0.5
+
+    assert not await com_mon.wait_quiet(0.05, 0.2, lambda: bool(ready))
+    assert time.monotonic() - com_mon.started >= 0.2
@@ -0,0 +1,56 @@
+from unittest.mock import AsyncMock, MagicMock
+
+import pytest
+
+from comitup_watch.dbint import DBInt
+
+
+@pytest.fixture
+def dbint(monkeypatch):
+    bus = MagicMock()
+    bus.__getitem__.return_value.__getitem__.return_value.get_async_interface = (
+        AsyncMock(side_effect=lambda intfc: object())
+    )
+
+    monkeypatch.setattr(DBInt, "bus", bus)
+    monkeypatch.setattr(DBInt, "_cache", DBInt._cache.__class__())
+    monkeypatch.setattr(DBInt, "cache_size", 2)
+    for counter in ["hits", "misses", "evictions"]:
+        monkeypatch.setattr(DBInt, counter, 0)
+
+    return DBInt
+
+@pytest.mark.asyncio
+async def test_dbint_cache_hit(dbint):
+    first = await dbint.get_interface("bus", "/a", "intfc")
+
+    assert await dbint.get_interface("bus", "/a", "intfc") is first
+    assert dbint.cache_stats() == (1, 1, 1, 0)
+
+@pytest.mark.asyncio
+async def test_dbint_cache_lru(dbint):
+    first = await dbint.get_interface("bus", "/a", "intfc")
+    await dbint.get_interface("bus", "/b", "intfc")
+    await dbint.get_interface("bus", "/a", "intfc")
+    await dbint.get_interface("bus", "/c", "intfc")
+
+    assert dbint.cache_stats().evictions == 1
+    assert await dbint.get_interface("bus", "/a", "intfc") is first
+    assert ("bus", "/b", "intfc") not in dbint._cache
+
+@pytest.mark.asyncio
+async def test_dbint_cache_ttl(dbint, monkeypatch):
+    monkeypatch.setattr(DBInt, "cache_ttl", 0)
+
+    first = await dbint.get_interface("bus", "/a", "intfc")
+
+    assert await dbint.get_interface("bus", "/a", "intfc") is not first
+
+@pytest.mark.asyncio
+async def test_dbint_invalidate(dbint):
+    await dbint.get_interface("bus", "/a", "intfc1")
+    await dbint.get_interface("bus", "/a", "intfc2")
+
+    dbint.invalidate("/a")
+
+    assert dbint.cache_stats().size == 0
@@ -0,0 +1,344 @@
+import asyncio
+
+import pytest
+
+from unittest.mock import AsyncMock, Mock
+
+import dbussy
+
+from comitup_watch.dbint import DBInt
+from comitup_watch.devicemon import (
+    AccessPoint,
+    APManager,
+    DeviceMonAction,
+    Coalescer,
+    DeviceMonitor,
+    ScanScheduler,
+    ap_from_props,
+)
+
+
+def make_ap(ssid):
+    return AccessPoint(ssid, 50, 2412, "00:11:22:33:44:55")
+
+def make_props(ssid):
+    return {
+        "Ssid": ["ay", list(ssid.encode())],
+        "Strength": ["y", 50],
+        "Frequency": ["u", 2412],
+        "HwAddress": ["s", "00:11:22:33:44:55"],
+    }
+
+@pytest.fixture
+def apmgr(monkeypatch):
+    ssids = {}
+
+    async def get_ap(ap_path):
+        if ap_path in ssids:
+            return make_ap(ssids[ap_path])
+        return None
+
+    async def new_aps():
+        return {path: make_ap(ssid) for path, ssid in ssids.items()}
+
+    monkeypatch.setattr(APManager, "get_ap", get_ap)
+    monkeypatch.setattr(APManager, "new_aps", new_aps)
+    monkeypatch.setattr(APManager, "_aps", {})
+    monkeypatch.setattr(APManager, "_ssid_refs", {})
+    monkeypatch.setattr(APManager, "_lock", asyncio.Lock())
+    monkeypatch.setattr(APManager, "_rescans", None)
+    monkeypatch.setattr(APManager, "event_queue", asyncio.Queue())
+
+    APManager.ssids = ssids
+    yield APManager
+    del APManager.ssids
+
+def events(apmgr):
+    result = []
+    while not apmgr.event_queue.empty():
+        msg = apmgr.event_queue.get_nowait()
+        result.append((msg.action, msg.ssid))
+    return result
+
+@pytest.mark.asyncio
+async def test_apmgr_refcount(apmgr):
+    apmgr.ssids.update({"/ap/1": "foo", "/ap/2": "foo"})
+
+    await apmgr.ap_added("/ap/1")
+    await apmgr.ap_added("/ap/2")
+
+    assert events(apmgr) == [(DeviceMonAction.ADDED, "foo")]
+
+    await apmgr.ap_removed("/ap/1")
+    assert events(apmgr) == []
+
+    await apmgr.ap_removed("/ap/2")
+    assert events(apmgr) == [(DeviceMonAction.REMOVED, "foo")]
+
+@pytest.mark.asyncio
+async def test_apmgr_add_twice(apmgr):
+    apmgr.ssids.update({"/ap/1": "foo"})
+
+    await apmgr.ap_added("/ap/1")
+    await apmgr.ap_added("/ap/1")
+    await apmgr.ap_removed("/ap/1")
+
+    assert events(apmgr) == [
+        (DeviceMonAction.ADDED, "foo"),
+        (DeviceMonAction.REMOVED, "foo"),
+    ]
+
+@pytest.mark.asyncio
+async def test_apmgr_unknown_removed(apmgr):
+    await apmgr.ap_removed("/ap/1")
+    await apmgr.ap_added("/ap/2")
+
+    assert events(apmgr) == []
+
+@pytest.mark.asyncio
+async def test_apmgr_reconcile(apmgr):
+    apmgr.ssids.update({"/ap/1": "foo", "/ap/2": "bar"})
+    await apmgr.ap_added("/ap/1")
+    events(apmgr)
+
+    del apmgr.ssids["/ap/1"]
+    await apmgr._update_ssid_list()
+
+    assert set(events(apmgr)) == {
+        (DeviceMonAction.ADDED, "bar"),
+        (DeviceMonAction.REMOVED, "foo"),
+    }
+    assert apmgr._ssid_refs == {"bar": 1}
+
+@pytest.mark.asyncio
+async def test_apmgr_refresh(apmgr):
+    apmgr.ssids.update({"/ap/1": "foo", "/ap/2": "foo", "/ap/3": "bar"})
+    await apmgr._update_ssid_list()
+    events(apmgr)
+
+    await apmgr.refresh()
+
+    assert sorted(events(apmgr)) == [
+        (DeviceMonAction.REFRESHED, "bar"),
+        (DeviceMonAction.REFRESHED, "foo"),
+    ]
+
+def test_ap_from_props():
+    assert ap_from_props(make_props("foo")) == make_ap("foo")
+
+def test_ap_from_props_no_ssid():
+    assert ap_from_props(make_props("")) is None
+    assert ap_from_props({}) is None
+
+@pytest.fixture
+def bulk(monkeypatch):
+    intfcs = {}
+
+    async def get_interface(busname, path, interface):
+        return intfcs[(path, interface)]
+
+    monkeypatch.setattr(APManager, "get_interface", get_interface)
+
+    return intfcs
+
+@pytest.mark.asyncio
+async def test_apmgr_managed_objects(bulk):
+    intfc = Mock()
+    intfc.GetManagedObjects = AsyncMock(
+        return_value=[
+            {
+                "/ap/1": {
+                    "org.freedesktop.NetworkManager.AccessPoint": make_props(
+                        "foo"
+                    )
+                },
+                "/dev/1": {"org.freedesktop.NetworkManager.Device": {}},
+            }
+        ]
+    )
+    bulk[("/org/freedesktop", "org.freedesktop.DBus.ObjectManager")] = intfc
+
+    assert await APManager.new_aps() == {"/ap/1": make_ap("foo")}
+
+@pytest.mark.asyncio
+async def test_apmgr_getall_fallback(bulk, monkeypatch):
+    intfc = Mock()
+    intfc.GetManagedObjects = AsyncMock(side_effect=dbussy.DBusError("x", "y"))
+    bulk[("/org/freedesktop", "org.freedesktop.DBus.ObjectManager")] = intfc
+
+    paths = ["/ap/{}".format(x) for x in range(40)]
+    for path in paths:
+        ap_intfc = Mock()
+        ap_intfc.GetAll = AsyncMock(return_value=[make_props(path)])
+        bulk[(path, "org.freedesktop.DBus.Properties")] = ap_intfc
+
+    monkeypatch.setattr(APManager, "update_ap_paths", AsyncMock(return_value=paths))
+
+    aps = await APManager.new_aps()
+
+    assert sorted(aps) == sorted(paths)
+    assert aps["/ap/3"].ssid == "/ap/3"
+
+@pytest.fixture
+def devmon(monkeypatch):
+    monkeypatch.setattr(DBInt, "bus", Mock())
+    monkeypatch.setattr(
+        DeviceMonitor, "is_wireless", AsyncMock(return_value=True)
+    )
+
+    monkeypatch.setattr(APManager, "request_rescan", Mock())
+
+    fxt = DeviceMonitor.__new__(DeviceMonitor)
+    fxt.devices = {}
+
+    return fxt
+
+@pytest.mark.asyncio
+async def test_devmon_subscribe_once(devmon):
+    await devmon.add_dev_path("/dev/1")
+    await devmon.add_dev_path("/dev/1")
+
+    assert list(devmon.devices) == ["/dev/1"]
+    assert DBInt.bus.listen_signal.call_count == 2
+
+@pytest.mark.asyncio
+async def test_devmon_unsubscribe(devmon):
+    await devmon.add_dev_path("/dev/1")
+    await devmon.device_removed_signal("/dev/1")
+
+    assert devmon.devices == {}
+    assert DBInt.bus.unlisten_signal.call_count == 2
+    assert APManager.request_rescan.call_count == 1
+    assert {
+        x.kwargs["name"] for x in DBInt.bus.unlisten_signal.call_args_list
+    } == {"AccessPointAdded", "AccessPointRemoved"}
+
+@pytest.mark.asyncio
+async def test_devmon_not_wireless(devmon):
+    devmon.is_wireless.return_value = False
+
+    await devmon.add_dev_path("/dev/1")
+
+    assert devmon.devices == {}
+
+@pytest.mark.asyncio
+async def test_devmon_signal_counts(devmon, apmgr):
+    await devmon.add_dev_path("/dev/1")
+    await devmon.devices["/dev/1"].ap_added_signal("/ap/1")
+
+    assert devmon.signal_counts() == {
+        "/dev/1": {"AccessPointAdded": 1, "AccessPointRemoved": 0}
+    }
+
+@pytest.fixture
+def coalescer():
+    runs = []
+
+    async def job():
+        runs.append(asyncio.get_event_loop().time())
+        await asyncio.sleep(0.05)
+
+    fxt = Coalescer(job, min_window=0.01, max_window=0.08, max_delay=0.2)
+    fxt.job_runs = runs
+
+    return fxt
+
+@pytest.mark.asyncio
+async def test_coalescer_merges(coalescer):
+    waiters = [coalescer.request() for _ in range(10)]
+    await asyncio.gather(*waiters)
+
+    assert len(coalescer.job_runs) == 1
+    assert coalescer.merged == 9
+    assert coalescer.window == 0.02
+
+@pytest.mark.asyncio
+async def test_coalescer_trailing_run(coalescer):
+    first = coalescer.request()
+    await asyncio.sleep(0.03)
+
+    # the job is now running
+    second = coalescer.request()
+    await asyncio.gather(first, second)
+
+    assert len(coalescer.job_runs) == 2
+
+@pytest.mark.asyncio
+async def test_coalescer_max_delay(coalescer):
+    coalescer.window = coalescer.max_window
+    start = asyncio.get_event_loop().time()
+
+    coalescer.request()
+    for _ in range(30):
+        await asyncio.sleep(0.01)
+        coalescer.request()
+
+    assert coalescer.job_runs
+    assert coalescer.job_runs[0] - start < 0.25
+
+@pytest.mark.asyncio
+async def test_coalescer_quiet_shrinks(coalescer):
+    coalescer.window = 0.08
+
+    await coalescer.run()
+
+    assert coalescer.window == 0.04
+
+@pytest.fixture
+def scanner(monkeypatch, apmgr):
+    monitor = Mock()
+    monitor.devices = {"/dev/1": None, "/dev/2": None}
+
+    fxt = ScanScheduler(monitor, min_interval=10, max_interval=40, settle=0)
+    fxt.states = {"/dev/1": 100, "/dev/2": 30}
+    fxt.get_state = AsyncMock(side_effect=lambda path: fxt.states[path])
+    fxt.request_scan = AsyncMock(return_value=True)
+
+    monkeypatch.setattr(APManager, "new_ssid_count", 0)
+
+    return fxt
+
+@pytest.mark.asyncio
+async def test_scanner_prefers_unconnected(scanner):
+    assert await scanner.targets() == ["/dev/2"]
+
+    scanner.states["/dev/2"] = 100
+
+    assert await scanner.targets() == ["/dev/1", "/dev/2"]
+
+@pytest.mark.parametrize("state", [0, 10, 20])
+@pytest.mark.asyncio
+async def test_scanner_skips_unavailable(scanner, state):
+    scanner.states["/dev/2"] = state
+
+    assert await scanner.targets() == ["/dev/1"]
+
+@pytest.mark.asyncio
+async def test_scanner_skips_activating(scanner):
+    scanner.states["/dev/1"] = 70
+    scanner.states["/dev/2"] = 50
+
+    assert await scanner.targets() == []
+
+@pytest.mark.asyncio
+async def test_scanner_backoff(scanner):
+    for _ in range(3):
+        await scanner.scan()
+
+    assert scanner.interval == 40
+    assert scanner.request_scan.call_count == 3
+
+@pytest.mark.asyncio
+async def test_scanner_reset_on_new_ssid(scanner):
+    scanner.interval = 40
+
+    async def request_scan(path):
+        await APManager.new_ssid("foo")
+        return True
+
+    scanner.request_scan = request_scan
+
+    await scanner.scan()
+
+    assert scanner.interval == 10
+    assert scanner.latency is not None
@@ -0,0 +1,186 @@
+import asyncio
+import json
+from unittest.mock import Mock
+
+import pytest
+
+from comitup_watch import httpapi
+from comitup_watch.httpapi import StatusServer, parse_address
+
+
+class FakeMon:
+    def __init__(self):
+        self.clist = Mock()
+        self.clist.snapshot.return_value = [{"host": "foo"}]
+        self.sinks = []
+
+    def add_sink(self, sink):
+        self.sinks.append(sink)
+
+@pytest.fixture
+async def server():
+    fxt = StatusServer(FakeMon(), port=0, client_buffer=2)
+    await fxt.start()
+    fxt.port = fxt.server.sockets[0].getsockname()[1]
+
+    yield fxt
+
+    await fxt.close()
+
+async def request(reader, writer, path, *headers):
+    lines = ["GET {} HTTP/1.1".format(path), "Host: test"] + list(headers)
+    writer.write(("\r\n".join(lines) + "\r\n\r\n").encode())
+
+    head = (await reader.readuntil(b"\r\n\r\n")).decode()
+    status = int(head.split(" ")[1])
+    fields = dict(
+        x.split(": ", 1) for x in head.strip().split("\r\n")[1:]
+    )
+    body = await reader.readexactly(int(fields.get("Content-Length", 0)))
+
+    return status, fields, body
+
+@pytest.mark.parametrize(
+    "text, result",
+    [
+        ("8080", ("127.0.0.1", 8080)),
+        ("0.0.0.0:80", ("0.0.0.0", 80)),
+        ("[::1]:80", ("::1", 80)),
+    ],
+)
+def test_httpapi_parse_address(text, result):
+    assert parse_address(text) == result
+
+def test_httpapi_parse_address_bad():
+    with pytest.raises(ValueError):
+        parse_address("host:port")
+
+@pytest.mark.asyncio
+async def test_httpapi_hosts_etag(server):
+    reader, writer = await asyncio.open_connection("127.0.0.1", server.port)
+
+    status, fields, body = await request(reader, writer, "/hosts")
+    assert status == 200
+    assert json.loads(body) == [{"host": "foo"}]
+
+    etag = fields["ETag"]
+    status, _, body = await request(
+        reader, writer, "/hosts", "If-None-Match: " + etag
+    )
+    assert status == 304
+    assert body == b""
+
+    server.on_change({"host": "foo", "changes": {"ping": True}})
+
+    status, fields, _ = await request(
+        reader, writer, "/hosts", "If-None-Match: " + etag
+    )
+    assert status == 200
+    assert fields["ETag"] != etag
+
+    await request(reader, writer, "/hosts")
+
+    assert server.snapshots == 2
+    assert server.not_modified == 1
+
+    writer.close()
+
+@pytest.mark.asyncio
+async def test_httpapi_errors(server):
+    reader, writer = await asyncio.open_connection("127.0.0.1", server.port)
+
+    status, _, _ = await request(reader, writer, "/nothing")
+    assert status == 404
+
+    writer.write(b"POST /hosts HTTP/1.1\r\nConnection: close\r\n\r\n")
+    head = await reader.read()
+    assert head.startswith(b"HTTP/1.1 405")
+
+@pytest.mark.asyncio
+async def test_httpapi_pipelined_body(server):
+    reader, writer = await asyncio.open_connection("127.0.0.1", server.port)
+
+    writer.write(b"POST /hosts HTTP/1.1\r\nContent-Length: 5\r\n\r\nhello")
+    status, _, _ = await request(reader, writer, "/hosts")
+    assert status == 405
+
+    head = await reader.readuntil(b"\r\n\r\n")
+    assert head.startswith(b"HTTP/1.1 200")
+
+@pytest.mark.parametrize(
+    "header, status",
+    [("Transfer-Encoding: chunked", 405), ("Content-Length: x", 400)],
+)
+@pytest.mark.asyncio
+async def test_httpapi_unread_body_closes(server, header, status):
+    reader, writer = await asyncio.open_connection("127.0.0.1", server.port)
+
+    writer.write(
+        "POST /hosts HTTP/1.1\r\n{}\r\n\r\n".format(header).encode()
+    )
+    reply = await asyncio.wait_for(reader.read(), 1)
+    assert reply.startswith("HTTP/1.1 {}".format(status).encode())
+    assert b"Connection: close" in reply
+
+async def open_events(server):
+    reader, writer = await asyncio.open_connection("127.0.0.1", server.port)
+    writer.write(b"GET /events HTTP/1.1\r\n\r\n")
+    await reader.readuntil(b"\r\n\r\n")
+
+    while not server.clients:
+        await asyncio.sleep(0.01)
+
+    return reader, writer
+
+@pytest.mark.asyncio
+async def test_httpapi_events(server):
+    reader, writer = await open_events(server)
+
+    server.on_change({"host": "foo", "changes": {"ssid": "foo"}})
+
+    event = await asyncio.wait_for(reader.readuntil(b"\n\n"), 1)
+    lines = event.decode().splitlines()
+
+    assert lines[0] == "id: 1"
+    assert json.loads(lines[1][len("data: "):]) == {
+        "host": "foo",
+        "changes": {"ssid": "foo"},
+    }
+
+    writer.close()
+
+@pytest.mark.asyncio
+async def test_httpapi_drops_slow_client(server):
+    reader, writer = await open_events(server)
+
+    for index in range(5):
+        server.on_change({"host": "host{}".format(index)})
+
+    assert server.dropped == 1
+    assert not server.clients
+
+    # the connection is closed
+    assert await asyncio.wait_for(reader.read(), 1) == b""
+
+    writer.close()
+
+@pytest.mark.asyncio
+async def test_httpapi_close_idle_client(server):
+    reader, writer = await asyncio.open_connection("127.0.0.1", server.port)
+    status, _, _ = await request(reader, writer, "/hosts")
+    assert status == 200
+
+    await asyncio.wait_for(server.close(), 1)
+
+    assert await asyncio.wait_for(reader.read(), 1) == b""
+    assert not server.connections
+
+@pytest.mark.asyncio
+async def test_httpapi_idle_timeout(server, monkeypatch):
+    monkeypatch.setattr(httpapi, "IDLE_TIMEOUT", 0.05)
+
+    reader, writer = await asyncio.open_connection("127.0.0.1", server.port)
+    status, _, _ = await request(reader, writer, "/hosts")
+    assert status == 200
+
+    assert await asyncio.wait_for(reader.read(), 1) == b""
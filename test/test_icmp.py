@@ -0,0 +1,51 @@
+import pytest
+
+from comitup_watch.icmp import (
+    IcmpPinger,
+    build_echo,
+    checksum,
+    parse_echo_reply,
+)
+
+
+def test_icmp_checksum():
+    packet = build_echo(0x1234, 7)
+
+    assert checksum(packet) == 0
+
+def test_icmp_parse_reply():
+    packet = bytearray(build_echo(0x1234, 7))
+    packet[0] = 0
+
+    assert parse_echo_reply(bytes(packet), False) == (0x1234, 7)
+
+def test_icmp_parse_raw_reply():
+    packet = bytearray(build_echo(0x1234, 7))
+    packet[0] = 0
+    ip_header = bytes([0x45]) + bytes(19)
+
+    assert parse_echo_reply(ip_header + bytes(packet), True) == (0x1234, 7)
+
+def test_icmp_parse_ignores_request():
+    assert parse_echo_reply(build_echo(0x1234, 7), False) is None
+
+@pytest.fixture
+async def pinger():
+    fxt = IcmpPinger()
+    if not fxt.open():
+        pytest.skip("ICMP sockets not permitted")
+
+    yield fxt
+
+    fxt.close()
+
+@pytest.mark.asyncio
+async def test_icmp_ping_localhost(pinger):
+    rtt = await pinger.ping("127.0.0.1", 1)
+
+    assert rtt is not None and rtt >= 0
+
+@pytest.mark.asyncio
+async def test_icmp_ping_timeout(pinger):
+    assert await pinger.ping("10.1.2.2", 0.1) is None
+    assert not pinger._pending
@@ -0,0 +1,87 @@
+import asyncio
+import subprocess
+import sys
+from unittest.mock import AsyncMock, Mock
+
+import pytest
+
+from comitup_watch.main import parse_args, print_snapshot, source_done
+
+
+def test_main_defers_heavy_imports():
+    code = (
+        "import sys, comitup_watch.main;"
+        "print(' '.join(x for x in ('zeroconf', 'ravel', 'dbussy')"
+        " if x in sys.modules))"
+    )
+    out = subprocess.run(
+        [sys.executable, "-c", code], capture_output=True, text=True, check=True
+    )
+
+    assert out.stdout.strip() == ""
+
+def test_main_parse_args_defaults():
+    args = parse_args([])
+
+    assert args.interface == []
+    assert args.ip_version is None
+
+def test_main_parse_args_ndjson(tmp_path):
+    assert parse_args(["--ndjson"]).ndjson is sys.stdout
+
+    path = tmp_path / "events.json"
+    args = parse_args(["--ndjson", str(path)])
+    args.ndjson.close()
+
+    assert path.exists()
+    assert parse_args([]).ndjson is None
+
+def test_main_parse_args_json_needs_once():
+    assert parse_args(["--once", "--json"]).json
+
+    with pytest.raises(SystemExit):
+        parse_args(["--json"])
+
+def test_main_parse_args_http():
+    assert parse_args(["--http", "8080"]).http == ("127.0.0.1", 8080)
+
+    with pytest.raises(SystemExit):
+        parse_args(["--http", "localhost:http"])
+
+@pytest.fixture
+def snapmon():
+    fxt = Mock()
+    fxt.run = AsyncMock()
+    fxt.wait_quiet = AsyncMock(return_value=True)
+    fxt.snapshot_lines.return_value = ["foo"]
+
+    return fxt
+
+@pytest.mark.asyncio
+async def test_main_snapshot_complete(snapmon, capsys):
+    args = parse_args(["--once"])
+
+    assert await print_snapshot(snapmon, args, None, {})
+
+    out = capsys.readouterr()
+    assert out.out == "foo\n"
+    assert out.err == ""
+
+@pytest.mark.asyncio
+async def test_main_snapshot_failed(snapmon, capsys):
+    snapmon.wait_quiet.return_value = False
+
+    async def fail():
+        raise OSError("no bus")
+
+    failures = {}
+    task = asyncio.create_task(fail())
+    await asyncio.wait([task])
+    source_done(Mock(), failures, "NetworkManager", task)
+
+    args = parse_args(["--once"])
+    assert not await print_snapshot(snapmon, args, None, failures)
+
+    err = capsys.readouterr().err
+    assert "NetworkManager source failed - no bus" in err
+    assert "deadline reached" in err
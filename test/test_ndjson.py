@@ -0,0 +1,61 @@
+import asyncio
+import io
+import json
+from unittest.mock import Mock
+
+import pytest
+
+from comitup_watch.ndjson import NdjsonWriter
+
+
+def lines(out):
+    return [json.loads(x) for x in out.getvalue().splitlines()]
+
+@pytest.mark.asyncio
+async def test_ndjson_flush_interval():
+    out = io.StringIO()
+    writer = NdjsonWriter(out, flush_interval=0.05)
+
+    writer({"host": "foo", "changes": {"ssid": "foo"}})
+    writer({"host": "bar", "changes": {"ping": True}})
+    assert out.getvalue() == ""
+
+    await asyncio.sleep(0.1)
+
+    assert lines(out) == [
+        {"host": "foo", "changes": {"ssid": "foo"}},
+        {"host": "bar", "changes": {"ping": True}},
+    ]
+    assert writer.writes == 1
+
+@pytest.mark.asyncio
+async def test_ndjson_flush_size():
+    out = io.StringIO()
+    writer = NdjsonWriter(out, flush_interval=3600, buffer_size=100)
+
+    for index in range(20):
+        writer({"host": "host{}".format(index)})
+
+    assert 0 < len(lines(out)) < 20
+
+    writer.flush()
+
+    assert len(lines(out)) == 20
+    assert writer.flush_handle is None
+
+    writer.close()
+    assert out.closed
+
+@pytest.mark.asyncio
+async def test_ndjson_broken_pipe():
+    out = Mock()
+    out.write.side_effect = BrokenPipeError()
+    writer = NdjsonWriter(out)
+
+    writer({"host": "foo"})
+    writer.flush()
+    writer({"host": "bar"})
+
+    assert writer.out is None
+    assert out.write.call_count == 1
+    assert not writer.pending
@@ -1,12 +1,14 @@
 
 import asyncio
+import time
 from collections import namedtuple
 from typing import Any, NamedTuple
 
 
 import pytest
 
-from comitup_watch.pingmon import ping_host, ping
+from comitup_watch import pingmon
+from comitup_watch.pingmon import PingScheduler, ping
 
 @pytest.mark.asyncio
 async def test_ping_asyncio_null():
@@ -48,7 +50,7 @@ async def test_ping_generic_gen():
 @pytest.mark.asyncio
 async def test_ping_pinggen_base(pingen):
     results = []
-    async for host in ping_host(0.02, pingen.queue, pingen.clist):
+    async for host in PingScheduler(pingen.queue, pingen.clist, 0.02):
         results.append(host)
 
         if len(results) == 4:
@@ -61,7 +63,7 @@ async def test_ping_pinggen_base(pingen):
 async def test_ping_pinggen_base(pingen):
     await pingen.queue.put("baz")
     results = []
-    async for host in ping_host(0, pingen.queue, pingen.clist):
+    async for host in PingScheduler(pingen.queue, pingen.clist, 0):
         results.append(host)
 
         if len(results) == 5:
@@ -73,7 +75,7 @@ async def test_ping_pinggen_base(pingen):
 async def test_ping_pinggen_timeout(pingen):
 
 
-    ph = ping_host(10, pingen.queue, pingen.clist)
+    ph = PingScheduler(pingen.queue, pingen.clist, 10)
 
     # cycle through the hosts, to get to a timeout situation
     assert await ph.__anext__() == "foo"
@@ -85,8 +87,137 @@ async def test_ping_pinggen_timeout(pingen):
     # this should return right away
     assert await ph.__anext__() == "baz"
 
+@pytest.mark.asyncio
+async def test_ping_sched_changed_is_fast(pingen):
+    sched = PingScheduler(pingen.queue, pingen.clist, 10, fast=0.5)
+    assert await sched.next() == "foo"
+
+    sched.record("foo", True)
+    assert sched.hosts["foo"].interval == 0.5
+
+    sched.record("foo", False)
+    assert sched.hosts["foo"].interval == 0.5
+
+@pytest.mark.asyncio
+async def test_ping_sched_changed_wakes_next(pingen):
+    pingen.clist.pop()
+    sched = PingScheduler(pingen.queue, pingen.clist, 3, fast=0.2)
+    assert await sched.next() == "foo"
+
+    # already waiting on the provisional due time, a period away
+    waiter = asyncio.create_task(sched.next())
+    await asyncio.sleep(0.05)
+
+    start = time.monotonic()
+    sched.record("foo", True)
+
+    assert await asyncio.wait_for(waiter, 1) == "foo"
+    assert time.monotonic() - start < 0.4
+    assert sched.late == 0
+
+@pytest.mark.parametrize("status, limit", [(True, 60), (False, 300)])
+@pytest.mark.asyncio
+async def test_ping_sched_backoff(pingen, status, limit):
+    sched = PingScheduler(
+        pingen.queue, pingen.clist, 10, max_up=60, max_down=300
+    )
+    await sched.next()
+
+    intervals = []
+    for _ in range(8):
+        sched.record("foo", status)
+        intervals.append(sched.hosts["foo"].interval)
+
+    assert intervals[:3] == [0.5, 10, 20]
+    assert intervals[-1] == limit
+
+@pytest.mark.asyncio
+async def test_ping_sched_drops_lost_hosts(pingen):
+    sched = PingScheduler(pingen.queue, pingen.clist, 10)
+    await sched.next()
+
+    pingen.clist.pop()
+    sched.reconcile(0)
+
+    assert list(sched.hosts) == ["foo"]
+
 @pytest.mark.parametrize("case", [("127.0.0.1", True), ("10.1.2.2", False)])
 # @pytest.mark.parametrize("case", [("127.0.0.1", True)])
 @pytest.mark.asyncio
 async def test_ping(case):
     assert await ping(case[0]) == case[1]
+
+class FakeHost(NamedTuple):
+    host: str
+    ipv4: str
+    ping_evicted: bool = False
+
+class FakeCList(list):
+    def get_host(self, hostname):
+        return {x.host: x for x in self}.get(hostname)
+
+@pytest.mark.asyncio
+async def test_ping_amain_concurrent(monkeypatch):
+    active = []
+    peak = []
+
+    async def fake_ping(ip):
+        active.append(ip)
+        peak.append(len(active))
+        await asyncio.sleep(0.05)
+        active.remove(ip)
+        return True
+
+    monkeypatch.setattr("comitup_watch.pingmon.ping", fake_ping)
+
+    clist = FakeCList(FakeHost("host{}".format(x), "ip") for x in range(8))
+    event_q = asyncio.Queue()
+
+    task = asyncio.create_task(
+        pingmon.amain(event_q, asyncio.Queue(), clist, period=10, limit=4)
+    )
+
+    msgs = [await asyncio.wait_for(event_q.get(), 1) for _ in range(8)]
+    task.cancel()
+
+    assert max(peak) == 4
+    assert {x.name for x in msgs} == {x.host for x in clist}
+    assert all(x.action == pingmon.PingAction.ADDED for x in msgs)
+
+@pytest.mark.asyncio
+async def test_ping_pass_once(monkeypatch):
+    pinged = []
+
+    async def fake_ping(ip):
+        pinged.append(ip)
+        await asyncio.sleep(0.01)
+        return True
+
+    monkeypatch.setattr("comitup_watch.pingmon.ping", fake_ping)
+
+    clist = FakeCList([FakeHost("foo", "1.1.1.1"), FakeHost("bar", "2.2.2.2")])
+    event_q = asyncio.Queue()
+    req_q = asyncio.Queue()
+    pinger = pingmon.PingPass(event_q, req_q, clist)
+    assert pinger.idle()
+
+    task = asyncio.create_task(pinger.run())
+    for hostname in ["foo", "bar", "foo"]:
+        req_q.put_nowait(hostname)
+    assert not pinger.idle()
+
+    msgs = [await asyncio.wait_for(event_q.get(), 1) for _ in range(2)]
+    await asyncio.sleep(0.05)
+    task.cancel()
+
+    assert sorted(pinged) == ["1.1.1.1", "2.2.2.2"]
+    assert {x.name for x in msgs} == {"foo", "bar"}
+    assert pinger.idle()
+
+def test_ping_get_host_ip_evicted():
+    clist = FakeCList(
+        [FakeHost("foo", "1.1.1.1"), FakeHost("bar", "2.2.2.2", True)]
+    )
+
+    assert pingmon.get_host_ip("foo", clist) == "1.1.1.1"
+    assert pingmon.get_host_ip("bar", clist) is None
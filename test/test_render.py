@@ -0,0 +1,112 @@
+import io
+
+import pytest
+
+from comitup_watch.render import (
+    CLEAR_BELOW,
+    CLEAR_SCREEN,
+    Table,
+    TermRenderer,
+    goto,
+)
+
+
+@pytest.fixture
+def renderer():
+    return TermRenderer(io.StringIO(), max_fps=0)
+
+def written(renderer):
+    text = renderer.out.getvalue()
+    renderer.out.seek(0)
+    renderer.out.truncate()
+    return text
+
+def test_render_first_frame_full(renderer):
+    renderer.render(["one", "two"])
+
+    text = written(renderer)
+    assert text.startswith(CLEAR_SCREEN)
+    assert "one" in text and "two" in text
+
+def test_render_diff_only(renderer):
+    renderer.render(["one", "two", "three"])
+    written(renderer)
+
+    renderer.render(["one", "TWO", "three"])
+
+    text = written(renderer)
+    assert text.startswith(goto(1) + "TWO")
+    assert "one" not in text and "three" not in text
+
+def test_render_unchanged_writes_nothing(renderer):
+    renderer.render(["one"])
+    written(renderer)
+
+    renderer.render(["one"])
+
+    assert written(renderer) == ""
+    assert renderer.frames == 1
+
+def test_render_shrink_clears(renderer):
+    renderer.render(["one", "two"])
+    written(renderer)
+
+    renderer.render(["one"])
+
+    assert written(renderer) == goto(1) + CLEAR_BELOW
+
+def test_render_invalidate(renderer):
+    renderer.render(["one"])
+    renderer.invalidate()
+    written(renderer)
+
+    renderer.render(["one"])
+
+    assert written(renderer).startswith(CLEAR_SCREEN)
+
+def test_render_delay():
+    renderer = TermRenderer(io.StringIO(), max_fps=2)
+    assert renderer.delay() == 0
+
+    renderer.render(["one"])
+
+    assert 0 < renderer.delay() <= 0.5
+
+def test_table_widths():
+    table = Table(["A", "B"])
+    table.set_row("x", ["12345", "1"])
+
+    assert table.widths() == (5, 3)
+
+    table.remove_row("x")
+
+    assert table.widths() == (3, 3)
+
+def test_table_ansi_width():
+    table = Table(["A", "B"])
+    table.set_row("x", ["\x1b[32m12345\x1b[0m", "1"])
+
+    assert table.widths() == (5, 3)
+
+def test_table_lines():
+    table = Table(["A", "B"])
+    table.set_row("y", ["y", "2"])
+    table.set_row("x", ["xxxx", "1"])
+
+    assert table.lines(["x", "y"]) == [
+        "A     B",
+        "----  ---",
+        "xxxx  1",
+        "y     2",
+    ]
+
+def test_table_line_cache():
+    table = Table(["A", "B"])
+    table.set_row("x", ["x", "1"])
+    widths = table.widths()
+
+    first = table.line("x", widths)
+    assert table.line("x", widths) is first
+
+    table.set_row("x", ["x", "2"])
+    assert table.line("x", widths) == "x    2"